@@ -5,14 +5,19 @@ from agentic_db.orchestrator import Orchestrator
 
 
 class AsyncAgenticDatabase:
-    def __init__(self):
+    def __init__(self, read_only=False, embedding_backend=None, embedding_worker=False, parallel_ingest=False):
         self.document_queue = queue.Queue()
         self.prompt_queue = queue.Queue()
         self.currently_processing = None
         self.processing_start_time = None
         self.lock = threading.Lock()
         self.processing_thread = None  # No processing thread initially
-        self.orchestrator = Orchestrator()
+        self.orchestrator = Orchestrator(
+            read_only=read_only,
+            embedding_backend=embedding_backend,
+            embedding_worker=embedding_worker,
+            parallel_ingest=parallel_ingest,
+        )
         self.default_database = None
     
     def add_document(self, document, db_file=None, callback=None):
@@ -32,8 +37,18 @@ class AsyncAgenticDatabase:
 
     
     
-    def add_prompt(self, prompt, callback=None):
-        """Add a prompt to the prompt queue with an optional callback."""
+    def add_prompt(self, prompt, callback=None, on_token=None):
+        """Add a prompt to the prompt queue with an optional callback.
+
+        The prompt may be packaged as (prompt, db_file), where db_file can also be a list of
+        database files to run a federated query across all of them, or as (prompt, db_file, tag_filter)
+        to scope the query to some original documents, document types or a date range.
+
+        If on_token is given, the answer is streamed: on_token(text) is called from the processing
+        thread with every answer token as it is generated, before callback gets the full response.
+
+        If answering fails, callback gets a response with no answer and the exception under "error",
+        and the processing thread moves on to the next task."""
         if not isinstance(prompt, (list, tuple)):
             if self.default_database is not None:
                 prompt = (prompt, self.default_database)
@@ -41,8 +56,33 @@ class AsyncAgenticDatabase:
                 raise ValueError("Database must be provided if default database is not set.")
 
         with self.lock:
-            self.prompt_queue.put((prompt, callback))
+            self.prompt_queue.put((prompt, callback, on_token))
             self.get_process()
+
+    def stream_prompt(self, prompt, callback=None):
+        """Add a prompt like add_prompt and return an iterator over its answer tokens, which ends when the answer is complete.
+        If answering fails, the iterator raises the exception after the tokens generated so far."""
+        tokens = queue.Queue()
+
+        def on_complete(response):
+            # The iterator is ended even if the caller's callback fails
+            try:
+                if callback:
+                    callback(response)
+            finally:
+                tokens.put(response.get("error"))
+
+        def iterate():
+            while True:
+                token = tokens.get()
+                if isinstance(token, Exception):
+                    raise token
+                if token is None:
+                    return
+                yield token
+
+        self.add_prompt(prompt, on_complete, on_token=tokens.put)
+        return iterate()
     
     def queue_size(self):
         """Return the combined size of both queues."""
@@ -98,6 +138,42 @@ class AsyncAgenticDatabase:
     def create_database(self, title):
         return self.orchestrator.create_database(title)
 
+    def build_serving_index(self, db_file):
+        return self.orchestrator.build_serving_index(db_file)
+
+    def reduce_dimensions(self, db_file, dim):
+        return self.orchestrator.reduce_dimensions(db_file, dim)
+
+    def evaluate_reduction(self, db_file, dim):
+        return self.orchestrator.evaluate_reduction(db_file, dim)
+
+    def build_neighbor_graph(self, db_file):
+        return self.orchestrator.build_neighbor_graph(db_file)
+
+    def get_model_stats(self):
+        return self.orchestrator.get_model_stats()
+
+    def get_prompt_cache_stats(self):
+        return self.orchestrator.get_prompt_cache_stats()
+
+    def set_step_model(self, step, size):
+        return self.orchestrator.set_step_model(step, size)
+
+    def get_answer_cache_stats(self):
+        return self.orchestrator.get_answer_cache_stats()
+
+    def set_memoization(self, enabled):
+        return self.orchestrator.set_memoization(enabled)
+
+    def get_memo_stats(self):
+        return self.orchestrator.get_memo_stats()
+
+    def set_speculative_decoding(self, mode):
+        return self.orchestrator.set_speculative_decoding(mode)
+
+    def get_generation_stats(self):
+        return self.orchestrator.get_generation_stats()
+
     def get_number_of_documents(self, db_file):
         return self.orchestrator.get_number_of_documents(db_file)
 
@@ -107,6 +183,9 @@ class AsyncAgenticDatabase:
     def remove_original_document(self, db_file, doc_uuid):
         return self.orchestrator.remove_original_document(db_file, doc_uuid)
 
+    def reconcile_database(self, db_file):
+        return self.orchestrator.reconcile_database(db_file)
+
     def get_all_tags(self, db_file):
         return self.orchestrator.get_all_tags(db_file)
     
@@ -130,6 +209,9 @@ class AsyncAgenticDatabase:
     def load_conversation_history(self):
         return self.orchestrator.load_conversation_history()
 
+    def set_conversation_token_budget(self, token_budget):
+        return self.orchestrator.set_conversation_token_budget(token_budget)
+
     def process_queues(self):
         """Main processing method that checks the prompt queue first, then documents."""
         self.orchestrator.llm_handler.get_model()
@@ -137,9 +219,10 @@ class AsyncAgenticDatabase:
             # Check for prompts first
             if not self.prompt_queue.empty():
                 prompt_text, database_title = None, None
-                prompt, callback = self.prompt_queue.get()
+                prompt, callback, on_token = self.prompt_queue.get()
                 with self.lock:
                     prompt_text, database_title = prompt[0], prompt[1]
+                    tag_filter = prompt[2] if len(prompt) > 2 else None
 
                     self.currently_processing = f"Prompt: {prompt_text}"
                     self.processing_start_time = datetime.now()
@@ -147,7 +230,13 @@ class AsyncAgenticDatabase:
                 if database_title is None:
                     database_title = self.default_database
 
-                answer, context = self.orchestrator.process_prompt(prompt_text, database_title)
+                # A failed prompt is reported to its caller, the thread keeps serving the queues
+                try:
+                    answer, context = self.orchestrator.process_prompt(prompt_text, database_title, tag_filter, on_token)
+                    error = None
+                except Exception as e:
+                    print(f"Failed to answer prompt: {e}")
+                    answer, context, error = None, [], e
 
                 # create a response object
                 response = {
@@ -155,6 +244,8 @@ class AsyncAgenticDatabase:
                     "response": answer,
                     "context": context
                 }
+                if error is not None:
+                    response["error"] = error
 
                 # Call the callback function if provided
                 if callback:
@@ -185,10 +276,18 @@ class AsyncAgenticDatabase:
                     callback(response)
             
             elif self.orchestrator.get_mode() == "single_query":
+                # add_prompt and add_document queue under the lock, so nothing can be queued for this thread once it is detached
+                with self.lock:
+                    if not self.prompt_queue.empty() or not self.document_queue.empty():
+                        continue
+                    self.processing_thread = None
+
                 # Both queues are empty, so shut down the thread
                 print("Both queues are empty. Shutting down processor.")
+                # models stay resident until idle past the timeout, so the next prompt doesn't reload them
                 self.orchestrator.llm_handler.release_model()
                 self.orchestrator.tag_handler.release_model()
+                self.orchestrator.residency.evict_idle()
                 self.currently_processing = None
                 self.processing_start_time = None
                 return
\ No newline at end of file
@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from agentic_db.handlers.lazy_import import lazy_import
+
+np = lazy_import("numpy")
+
+ANSWER_CACHE_DIR = 'databases/answers'
+# prompts at least this similar (cosine of their embeddings) to a cached prompt get its answer
+answer_cache_similarity = 0.93
+# answers kept per database, least recently used ones are dropped beyond it
+answer_cache_size = 1000
+
+'''
+The answer cache handler module for agentic database. Caches single query answers and their context per database
+(<ANSWER_CACHE_DIR>/<database>-answers.db), so repeated questions skip the roadmap, tag search, relevance selection and
+answer generation. A prompt matches a cached one when their normalized text is equal, or else when their embeddings are
+similar enough. Entries are scoped (e.g. by system prompt and tag filter) and stored with the version of the database they were
+answered from; entries of an older version are dropped on the next lookup, so adding or removing documents invalidates them.
+
+The module provides the following functions:
+
+- AnswerCacheHandler(encode): encode(texts) returns unit length embeddings of the texts.
+- normalize_prompt(prompt): lowercases the prompt and keeps only its words.
+    return: str
+- get_answer(title, scope, prompt, version): returns the cached answer and context for the prompt, if any.
+    return: (str, [str]) | None
+- store_answer(title, scope, prompt, version, answer, context): caches the answer and context for the prompt.
+    return: None
+- delete_cache(title): deletes the answer cache of a database.
+    return: None
+- get_stats(): returns exact and similar prompt hits and misses since startup.
+    return: {'exact_hits': int, 'similar_hits': int, 'misses': int}
+'''
+
+class AnswerCacheHandler:
+
+    def __init__(self, encode):
+        self.encode = encode
+        self.lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0}
+
+    def normalize_prompt(self, prompt):
+        return " ".join(re.findall(r"\w+", prompt.lower()))
+
+    def connect(self, title):
+        if not os.path.exists(ANSWER_CACHE_DIR):
+            os.makedirs(ANSWER_CACHE_DIR)
+
+        conn = sqlite3.connect(os.path.join(ANSWER_CACHE_DIR, f"{title}-answers.db"))
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            vector BLOB NOT NULL,
+            answer TEXT NOT NULL,
+            context TEXT NOT NULL,
+            version TEXT NOT NULL,
+            last_used TEXT NOT NULL,
+            UNIQUE (scope, prompt)
+        )''')
+        conn.commit()
+
+        return conn
+
+    def get_answer(self, title, scope, prompt, version):
+        normalized = self.normalize_prompt(prompt)
+
+        with self.lock:
+            conn = self.connect(title)
+            cursor = conn.cursor()
+
+            # Answers from before the last document change may be missing or citing documents
+            cursor.execute('DELETE FROM answers WHERE version != ?', (version,))
+
+            cursor.execute('''
+            SELECT id, answer, context FROM answers WHERE scope = ? AND prompt = ?
+            ''', (scope, normalized))
+            row = cursor.fetchone()
+
+            if row is not None:
+                self.stats["exact_hits"] += 1
+            else:
+                cursor.execute('SELECT id, vector, answer, context FROM answers WHERE scope = ?', (scope,))
+                rows = cursor.fetchall()
+
+                if rows:
+                    vectors = np.frombuffer(b"".join(r[1] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+                    similarities = vectors @ self.encode([normalized])[0]
+                    best = int(similarities.argmax())
+                    if similarities[best] >= answer_cache_similarity:
+                        row = (rows[best][0], rows[best][2], rows[best][3])
+                        self.stats["similar_hits"] += 1
+
+            if row is None:
+                self.stats["misses"] += 1
+            else:
+                cursor.execute('UPDATE answers SET last_used = ? WHERE id = ?', (datetime.now().isoformat(), row[0]))
+
+            conn.commit()
+            conn.close()
+
+        if row is None:
+            return None
+        return row[1], json.loads(row[2])
+
+    def store_answer(self, title, scope, prompt, version, answer, context):
+        normalized = self.normalize_prompt(prompt)
+        vector = self.encode([normalized])[0].astype(np.float32)
+
+        with self.lock:
+            conn = self.connect(title)
+            cursor = conn.cursor()
+
+            cursor.execute('''
+            INSERT OR REPLACE INTO answers (scope, prompt, vector, answer, context, version, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (scope, normalized, vector.tobytes(), answer, json.dumps(context or []), version, datetime.now().isoformat()))
+
+            cursor.execute('''
+            DELETE FROM answers WHERE id NOT IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT ?)
+            ''', (answer_cache_size,))
+
+            conn.commit()
+            conn.close()
+
+    def delete_cache(self, title):
+        cache_path = os.path.join(ANSWER_CACHE_DIR, f"{title}-answers.db")
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
@@ -0,0 +1,105 @@
+# tokens the chat history may take before older turns are folded into the rolling summary
+conversation_token_budget = 8000
+# most recent messages kept verbatim when compacting, fewer are kept only if they alone exceed the budget
+recent_messages_kept = 4
+# chat template tokens around every message's content
+message_overhead_tokens = 5
+# longest rolling summary asked for, less when the system prompt and kept messages leave less of the target
+summary_token_limit = 600
+# fraction of the budget a compacted history is brought down to, the rest is room for new turns before the next compaction
+compaction_target = 0.5
+
+summary_prefix = "Summary of the earlier conversation:\n"
+
+'''
+The conversation handler module for agentic database. Keeps the chat mode conversation history within a token budget. The
+history is a plain list of chat messages that starts with the system prompt, so it is passed to the model as before, and
+messages appended to it from elsewhere are picked up on the next count. Token counts are kept per message and only new messages
+are tokenized. Once the history is over budget, every message but the system prompt and the most recent ones is folded,
+together with the previous summary, into a single summary message, so the prompt size stays bounded over long sessions. The
+history is brought down to compaction_target of the budget, so the following turns fit without summarizing again: the summary is
+asked to fit what the system prompt and the kept messages leave of that target, and cut down if it comes back longer.
+
+The module provides the following functions:
+
+- ConversationHandler(count_tokens, summarize, token_budget=conversation_token_budget, summary_tokens=summary_token_limit): count_tokens(text)
+    returns the tokens in a text, summarize(previous_summary, messages, max_tokens) returns a summary of at most max_tokens tokens of the
+    messages continuing the previous summary (or None).
+- reset(messages): replaces the history in place, keeping the same list object.
+    return: None
+- get_token_count(): returns the tokens in the history, counting only messages added since the last call.
+    return: int
+- compact(): folds older messages into the rolling summary if the history is over budget.
+    return: bool (whether the history was compacted)
+'''
+
+class ConversationHandler:
+
+    def __init__(self, count_tokens, summarize, token_budget=conversation_token_budget, summary_tokens=summary_token_limit):
+        self.count_tokens = count_tokens
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.messages = []
+        # token count of each message, in history order, for the counted prefix of the history
+        self.token_counts = []
+        self.has_summary = False
+
+    def reset(self, messages):
+        self.messages[:] = messages
+        self.token_counts = []
+        self.has_summary = False
+
+    def count_message(self, message):
+        return self.count_tokens(message["content"] or "") + message_overhead_tokens
+
+    def get_token_count(self):
+        for message in self.messages[len(self.token_counts):]:
+            self.token_counts.append(self.count_message(message))
+        return sum(self.token_counts)
+
+    def compact(self):
+        if self.get_token_count() <= self.token_budget:
+            return False
+
+        # The system prompt stays first, an existing summary right after it is folded into the new one
+        start = 2 if self.has_summary else 1
+        previous_summary = self.messages[1]["content"][len(summary_prefix):] if self.has_summary else None
+
+        # Keep as many recent messages as fit the target next to the system prompt and a full summary, always at least the latest one
+        target = int(self.token_budget * compaction_target)
+        summary_overhead = self.count_message({"content": summary_prefix})
+        kept = min(recent_messages_kept, len(self.messages) - start)
+        while kept > 1 and (
+            self.token_counts[0] + summary_overhead + self.summary_tokens + sum(self.token_counts[-kept:]) > target
+        ):
+            kept -= 1
+
+        end = len(self.messages) - kept
+        if end <= start:
+            return False
+
+        # The summary gets whatever the system prompt and kept messages leave of the target
+        summary_limit = min(
+            self.summary_tokens,
+            target - self.token_counts[0] - summary_overhead - sum(self.token_counts[-kept:]),
+        )
+        summary_limit = max(summary_limit, 1)
+
+        summary = self.summarize(previous_summary, self.messages[start:end], summary_limit)
+        summary = self.shorten(summary, summary_limit)
+        summary_message = {"role": "system", "content": summary_prefix + summary}
+
+        self.messages[1:end] = [summary_message]
+        self.token_counts[1:end] = [self.count_message(summary_message)]
+        self.has_summary = True
+        return True
+
+    def shorten(self, summary, max_tokens):
+        # Drops trailing words until the summary fits, in case it came back longer than asked for
+        summary_tokens = self.count_tokens(summary)
+        while summary and summary_tokens > max_tokens:
+            words = summary.split(" ")
+            summary = " ".join(words[:int(len(words) * max_tokens / summary_tokens)])
+            summary_tokens = self.count_tokens(summary)
+        return summary
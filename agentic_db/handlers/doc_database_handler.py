@@ -5,6 +5,9 @@ from datetime import datetime
 
 DATABASE_DIR = 'databases/docs'
 
+# keys understood by tag filters, see get_filter_predicates
+tag_filter_keys = ["original_uuids", "document_types", "date_from", "date_to"]
+
 '''
 The SQL doc database handler module for agentic database. Provides simple operations with some specificity to the 
 system as a whole (such as table creation). The module provides the following functions:
@@ -18,12 +21,20 @@ system as a whole (such as table creation). The module provides the following fu
     return: bool
 - delete_database: deletes the database with the given file name.
     return: bool
+- get_last_modified: returns when the database was last changed. Adding or removing documents updates it, so it serves as the
+    version of the database contents for caches.
+    return: str | None
 
 - add_entry_to_database: adds an entry to the database with the given file name. Increments all tag instances.
     return: bool
 - get_all_tags: returns a list of all tags in the database with the given file name.
     return: [str] | None
+- get_tag_instances: returns a dict of tag to number of sub-documents carrying it, for the given tags that exist.
+    return: {str: int} | None
+- get_tags_from_filter: returns the tags carried by sub-documents whose original document matches the tag filter.
+    return: [str] | None
 - get_document_uuid_tags_from_tag: returns a list of document UUIDs and a list of of tags that have the given tag(s).
+    Takes an optional tag filter to only consider documents in scope.
     return: [str], [str] | None
 - get_document_text_from_uuid: returns the text of the document with the given UUID.
     return: str | None
@@ -43,6 +54,11 @@ system as a whole (such as table creation). The module provides the following fu
 Databases have metadata stored in the metadata table about modification date and title for ordered display
 purposes.
 
+A tag filter is a dict scoping a query to part of a database, with any of the keys: original_uuids (list of original
+document uuids), document_types (list of document types), date_from and date_to (ISO dates, inclusive, compared against
+the date the original document was added). Documents added before dates were recorded have no date and never match a
+date range.
+
 '''
 
 def create_database_dir():
@@ -65,7 +81,8 @@ def create_database(title):
         pdf TEXT,
         youtube_url TEXT,
         document_type TEXT,
-        file_path TEXT
+        file_path TEXT,
+        date_added TEXT
     )''')
     
     cursor.execute('''
@@ -110,6 +127,41 @@ def create_database(title):
     
     return db_uuid + ".db"
 
+# Databases created before date_added existed get the column on first write or filtered read
+def ensure_date_added_column(cursor):
+    cursor.execute('PRAGMA table_info(original_documents)')
+    columns = [column[1] for column in cursor.fetchall()]
+    if "date_added" not in columns:
+        cursor.execute('ALTER TABLE original_documents ADD COLUMN date_added TEXT')
+
+def get_filter_predicates(tag_filter):
+    predicates, params = [], []
+
+    for key in tag_filter:
+        if key not in tag_filter_keys:
+            raise ValueError(f"Tag filter keys must be among {tag_filter_keys}")
+
+    if tag_filter.get("original_uuids") is not None:
+        placeholder = ', '.join(['?'] * len(tag_filter["original_uuids"]))
+        predicates.append(f'original_documents.uuid IN ({placeholder})')
+        params.extend(tag_filter["original_uuids"])
+
+    if tag_filter.get("document_types") is not None:
+        placeholder = ', '.join(['?'] * len(tag_filter["document_types"]))
+        predicates.append(f'original_documents.document_type IN ({placeholder})')
+        params.extend(tag_filter["document_types"])
+
+    # date_added is an ISO timestamp, so a bare date_to has to cover the whole day
+    if tag_filter.get("date_from") is not None:
+        predicates.append('original_documents.date_added >= ?')
+        params.append(tag_filter["date_from"])
+
+    if tag_filter.get("date_to") is not None:
+        predicates.append('original_documents.date_added <= ?')
+        params.append(tag_filter["date_to"] + "~" if len(tag_filter["date_to"]) == 10 else tag_filter["date_to"])
+
+    return ' AND '.join(predicates) if predicates else '1', params
+
 def update_last_modified(db_file, cursor):
     last_modified = datetime.now().isoformat()
     cursor.execute('''
@@ -136,6 +188,19 @@ def get_custom_prompt(db_file):
     conn.close()
     return custom_prompt[0] if custom_prompt else None
 
+def get_last_modified(db_file):
+    db_path = os.path.join(DATABASE_DIR, db_file)
+
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT last_modified FROM metadata')
+        last_modified = cursor.fetchone()
+        conn.close()
+        return last_modified[0] if last_modified else None
+    else:
+        return None
+
 
 
 def get_existing_databases():
@@ -202,10 +267,13 @@ def add_entry_to_database(db_file, text, sub_docs, pdf="null", youtube_url="null
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
         
+        ensure_date_added_column(cursor)
+
         uuid_str = str(uuid.uuid4())
+        date_added = datetime.now().isoformat()
         cursor.execute('''
-        INSERT INTO original_documents (uuid, text, pdf, youtube_url, document_type, file_path) VALUES (?, ?, ?, ?, ?, ?)
-        ''', (uuid_str, text, pdf, youtube_url, document_type, file_path))
+        INSERT INTO original_documents (uuid, text, pdf, youtube_url, document_type, file_path, date_added) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (uuid_str, text, pdf, youtube_url, document_type, file_path, date_added))
 
         for sub_doc in sub_docs:
             sub_doc_uuid = str(uuid.uuid4())
@@ -259,6 +327,52 @@ def get_all_tags(db_file):
     else:
         return None
 
+def get_tag_instances(db_file, tags):
+    db_path = os.path.join(DATABASE_DIR, db_file)
+    
+    if os.path.exists(db_path):
+        if isinstance(tags, str):
+            tags = [tags]
+        if not tags:
+            return {}
+
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+        placeholder = ', '.join(['?'] * len(tags))
+        cursor.execute(f'SELECT tag, instances FROM tags WHERE tag IN ({placeholder})', tuple(tags))
+        instances = cursor.fetchall()
+
+        conn.close()
+        return dict(instances)
+    else:
+        return None
+
+def get_tags_from_filter(db_file, tag_filter):
+    db_path = os.path.join(DATABASE_DIR, db_file)
+    
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+
+        ensure_date_added_column(cursor)
+        predicates, params = get_filter_predicates(tag_filter)
+
+        cursor.execute(f'''
+        SELECT DISTINCT tags.tag FROM original_documents
+        JOIN documents ON documents.original_uuid = original_documents.uuid
+        JOIN document_tags ON documents.uuid = document_tags.document_uuid
+        JOIN tags ON document_tags.tag_id = tags.id
+        WHERE {predicates}
+        ''', tuple(params))
+        tags = cursor.fetchall()
+
+        conn.commit()
+        conn.close()
+        return [tag[0] for tag in tags]
+    else:
+        return None
+
 def get_all_original_document_file_paths(db_file):
     db_path = os.path.join(DATABASE_DIR, db_file)
     
@@ -275,13 +389,19 @@ def get_all_original_document_file_paths(db_file):
         return None
 
 # tag may be a string or a list of strings
-def get_document_uuid_tags_from_tags(db_file, tags):
+def get_document_uuid_tags_from_tags(db_file, tags, tag_filter=None):
     db_path = os.path.join(DATABASE_DIR, db_file)
     
     if os.path.exists(db_path):
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
 
+        if tag_filter:
+            ensure_date_added_column(cursor)
+            predicates, filter_params = get_filter_predicates(tag_filter)
+        else:
+            predicates, filter_params = '1', []
+
         uuids_with_tags = {}
 
         if isinstance(tags, list) and len(tags) > 0:
@@ -291,11 +411,12 @@ def get_document_uuid_tags_from_tags(db_file, tags):
             placeholder = ', '.join(['?'] * len(all_tags))
             query = f'''
             SELECT documents.uuid, tags.tag FROM documents
+            JOIN original_documents ON documents.original_uuid = original_documents.uuid
             JOIN document_tags ON documents.uuid = document_tags.document_uuid
             JOIN tags ON document_tags.tag_id = tags.id
-            WHERE tags.tag IN ({placeholder})
+            WHERE tags.tag IN ({placeholder}) AND {predicates}
             '''
-            cursor.execute(query, tuple(all_tags))
+            cursor.execute(query, tuple(all_tags) + tuple(filter_params))
             results = cursor.fetchall()
 
             for doc_uuid, tag in results:
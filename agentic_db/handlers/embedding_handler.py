@@ -0,0 +1,125 @@
+import warnings
+from agentic_db.handlers.lazy_import import lazy_import
+
+huggingface_hub = lazy_import("huggingface_hub")
+np = lazy_import("numpy")
+
+MODELS_DIR = 'models/embedding'
+model_name = 'sentence-transformers/all-MiniLM-L6-v2'
+# dynamically quantized (uint8) export of the same model, published in the model repo
+onnx_model_file = 'onnx/model_quint8_avx2.onnx'
+max_seq_length = 256
+
+# backend used when none is given: "sentence_transformers", "torch_int8" or "onnx"
+embedding_backend = "sentence_transformers"
+
+parity_texts = [
+    "amazon_web_services", "aws_lambda", "serverless_computing", "microsoft_azure", "cloud_storage",
+    "prime_number_theorem", "euler_theorem", "coprimes", "turing_machines", "np_completeness",
+    "office_365", "windows_server", "hybrid_cloud", "kubernetes_clusters", "population",
+]
+
+'''
+The embedding handler module for agentic database. Provides interchangeable backends for the tag embedding model. Every backend
+exposes encode(texts) returning unit-length float32 vectors of all-MiniLM-L6-v2, so indexes built with one backend can be searched
+with another.
+
+- SentenceTransformerBackend: the reference PyTorch model through sentence_transformers.
+- QuantizedTorchBackend: the reference model with its Linear layers dynamically quantized to int8.
+- OnnxBackend: the int8 ONNX export run with onnxruntime and the tokenizers library, without importing torch.
+
+The module provides the following functions:
+
+- create_embedding_backend(backend): returns a loaded backend for the given name.
+    return: SentenceTransformerBackend | QuantizedTorchBackend | OnnxBackend
+- check_backend_parity(backend, reference="sentence_transformers", texts=parity_texts): encodes the texts with both backends
+    and compares them.
+    return: {'min_cosine': float, 'mean_cosine': float}
+'''
+
+class SentenceTransformerBackend:
+
+    def __init__(self):
+        from sentence_transformers import SentenceTransformer
+
+        warnings.filterwarnings("ignore", category=FutureWarning, message=".*clean_up_tokenization_spaces.*")
+
+        self.model = SentenceTransformer(model_name, cache_folder=MODELS_DIR)
+        self.model.tokenizer.clean_up_tokenization_spaces = True
+
+    def encode(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+        return self.model.encode(texts, normalize_embeddings=True).astype('float32')
+
+
+class QuantizedTorchBackend(SentenceTransformerBackend):
+
+    def __init__(self):
+        super().__init__()
+        import torch
+
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxBackend:
+
+    def __init__(self):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_path = huggingface_hub.hf_hub_download(repo_id=model_name, filename=onnx_model_file, cache_dir=MODELS_DIR)
+        tokenizer_path = huggingface_hub.hf_hub_download(repo_id=model_name, filename='tokenizer.json', cache_dir=MODELS_DIR)
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+        self.tokenizer.enable_truncation(max_length=max_seq_length)
+
+        self.session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def encode(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+        }
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+
+        token_embeddings = self.session.run(None, feeds)[0]
+
+        # Mean pooling over real tokens followed by L2 normalization, as in the sentence_transformers pipeline
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+        return pooled.astype('float32')
+
+
+backends = {
+    "sentence_transformers": SentenceTransformerBackend,
+    "torch_int8": QuantizedTorchBackend,
+    "onnx": OnnxBackend,
+}
+
+def create_embedding_backend(backend=None):
+    if backend is None:
+        backend = embedding_backend
+    if backend not in backends:
+        raise ValueError(f"Embedding backend must be one of {list(backends)}")
+    return backends[backend]()
+
+def check_backend_parity(backend, reference="sentence_transformers", texts=parity_texts):
+    reference_vectors = create_embedding_backend(reference).encode(texts)
+    candidate_vectors = create_embedding_backend(backend).encode(texts)
+
+    # Both sets are unit length, so the row-wise dot product is the cosine similarity
+    cosines = (reference_vectors * candidate_vectors).sum(axis=1)
+
+    return {"min_cosine": float(cosines.min()), "mean_cosine": float(cosines.mean())}
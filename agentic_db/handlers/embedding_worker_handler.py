@@ -0,0 +1,184 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import threading
+from agentic_db.handlers.embedding_handler import create_embedding_backend
+from agentic_db.handlers.lazy_import import lazy_import
+
+np = lazy_import("numpy")
+
+embedding_dim = 384
+# shared memory arena: num_slots request slots of slot_capacity vectors each
+num_slots = 4
+slot_capacity = 256
+
+'''
+The embedding worker handler module for agentic database. Runs the tag embedding model in its own process so it stays warm and
+can work while llama generation holds the main process. Tag batches are sent over a pipe; vectors are written by the worker
+straight into a shared memory arena and read back by the client, so results are never pickled.
+
+EmbeddingWorker exposes the same encode(texts) as the embedding backends, plus submit(texts) which returns a PendingEmbedding
+immediately so embedding can overlap with other work. Requests are served in order; each in-flight request holds one arena slot,
+and batches larger than a slot are split across slots.
+
+The module provides the following functions:
+
+- EmbeddingWorker(backend=None): starts the worker process with the given embedding backend and waits until the model is loaded.
+    Raises RuntimeError if the worker fails to load it.
+- submit(texts): queues texts for embedding.
+    return: PendingEmbedding
+- PendingEmbedding.result(): waits for and returns the vectors.
+    return: np.ndarray
+- encode(texts): submit(texts).result()
+    return: np.ndarray
+- stop(): stops the worker process and frees the shared memory.
+    return: None
+'''
+
+def run_embedding_worker(conn, backend, shm_name):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    arena = np.ndarray((num_slots, slot_capacity, embedding_dim), dtype=np.float32, buffer=shm.buf)
+
+    try:
+        model = create_embedding_backend(backend)
+    except Exception as e:
+        conn.send(("error", str(e)))
+        del arena
+        shm.close()
+        return
+    conn.send(("ready",))
+
+    while True:
+        message = conn.recv()
+        if message[0] == "stop":
+            break
+
+        _, slot, texts = message
+        try:
+            arena[slot, :len(texts)] = model.encode(texts)
+            conn.send(("done", slot, len(texts)))
+        except Exception as e:
+            conn.send(("error", slot, str(e)))
+
+    del arena
+    shm.close()
+
+
+class PendingEmbedding:
+
+    def __init__(self, worker, chunks):
+        self.worker = worker
+        self.chunks = chunks
+
+    def result(self):
+        for chunk in self.chunks:
+            while "vectors" not in chunk:
+                # Nothing in flight means no response for this chunk is ever coming
+                if not self.worker.receive_next():
+                    raise RuntimeError("Embedding worker has no request in flight for this result")
+
+        for chunk in self.chunks:
+            if "error" in chunk:
+                raise RuntimeError(f"Embedding worker failed: {chunk['error']}")
+
+        if not self.chunks:
+            return np.zeros((0, embedding_dim), dtype=np.float32)
+        return np.concatenate([chunk["vectors"] for chunk in self.chunks])
+
+
+class EmbeddingWorker:
+
+    def __init__(self, backend=None):
+        self.lock = threading.RLock()
+
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots * slot_capacity * embedding_dim * 4)
+        self.arena = np.ndarray((num_slots, slot_capacity, embedding_dim), dtype=np.float32, buffer=self.shm.buf)
+        self.free_slots = list(range(num_slots))
+        # chunks awaiting a response, in the order they were sent
+        self.in_flight = []
+
+        # A forked child would inherit the parent's threads and llama state, spawn starts it clean
+        context = multiprocessing.get_context("spawn")
+        self.conn, worker_conn = context.Pipe()
+        self.process = context.Process(
+            target=run_embedding_worker, args=(worker_conn, backend, self.shm.name), daemon=True
+        )
+        self.process.start()
+        # Only the child holds its end now, so the pipe reports EOF once the child exits
+        worker_conn.close()
+
+        # Block until the worker has the model loaded
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            message = ("error", "worker process exited before loading the model")
+
+        if message[0] != "ready":
+            self.process.join()
+            self.process = None
+            self.conn.close()
+            del self.arena
+            self.shm.close()
+            self.shm.unlink()
+            raise RuntimeError(f"Embedding worker failed to start: {message[1]}")
+
+    def submit(self, texts):
+        if isinstance(texts, str):
+            texts = [texts]
+
+        chunks = []
+        for i in range(0, len(texts), slot_capacity):
+            chunks.append(self.submit_chunk(texts[i:i + slot_capacity]))
+
+        return PendingEmbedding(self, chunks)
+
+    def submit_chunk(self, texts):
+        with self.lock:
+            # Every slot is in use, wait for the oldest request to come back
+            while not self.free_slots:
+                self.receive_next()
+
+            slot = self.free_slots.pop(0)
+            chunk = {"slot": slot}
+            self.in_flight.append(chunk)
+            self.conn.send(("encode", slot, texts))
+            return chunk
+
+    def receive_next(self):
+        with self.lock:
+            if not self.in_flight:
+                return False
+
+            try:
+                kind, slot, payload = self.conn.recv()
+            except EOFError:
+                raise RuntimeError("Embedding worker process exited")
+            chunk = self.in_flight.pop(0)
+
+            if kind == "done":
+                # copy out of the arena so the slot can be reused
+                chunk["vectors"] = self.arena[slot, :payload].copy()
+            else:
+                chunk["error"] = payload
+                chunk["vectors"] = None
+
+            self.free_slots.append(slot)
+            return True
+
+    def encode(self, texts):
+        return self.submit(texts).result()
+
+    def stop(self):
+        with self.lock:
+            if self.process is None:
+                return
+
+            while self.in_flight:
+                self.receive_next()
+
+            self.conn.send(("stop",))
+            self.process.join()
+            self.process = None
+
+            del self.arena
+            self.shm.close()
+            self.shm.unlink()
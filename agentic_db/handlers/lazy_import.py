@@ -0,0 +1,35 @@
+import importlib.util
+import sys
+
+'''
+Deferred imports for the heavy dependencies (llama_cpp, faiss, numpy, huggingface_hub) so that importing agentic_db and
+running database listing commands doesn't pay for torch, llama or faiss start-up. The module is only executed on first
+attribute access. A dependency that isn't installed raises ModuleNotFoundError on first use instead of at import time.
+
+- lazy_import(name): returns the module, loaded on first attribute access.
+    return: module
+'''
+
+class MissingModule:
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        raise ModuleNotFoundError(f"No module named '{self._name}'", name=self._name)
+
+
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return MissingModule(name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
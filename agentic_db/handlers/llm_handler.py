@@ -1,39 +1,142 @@
-import llama_cpp
-from huggingface_hub import hf_hub_download
 import os
+import re
+import queue
 import contextlib
 import json
+import time
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from agentic_db.handlers.print_handler import PrintHandler
+from agentic_db.handlers.prompt_cache_handler import PromptCacheHandler
+from agentic_db.handlers.lazy_import import lazy_import
+
+llama_cpp = lazy_import("llama_cpp")
+huggingface_hub = lazy_import("huggingface_hub")
+np = lazy_import("numpy")
 
 
 MODELS_DIR = "models\\llm"
 
-model_file_name = os.path.join(MODELS_DIR, "model_file_name.json")
+# gguf models by size, both Llama 3 instruct models so prompts and grammars carry over between them
+model_sources = {
+    "big": ("lmstudio-community/Meta-Llama-3.1-8B-Instruct-GGUF", "Meta-Llama-3.1-8B-Instruct-Q3_K_L.gguf"),
+    "small": ("lmstudio-community/Llama-3.2-1B-Instruct-GGUF", "Llama-3.2-1B-Instruct-Q4_K_M.gguf"),
+}
+model_file_names = {
+    "big": os.path.join(MODELS_DIR, "model_file_name.json"),
+    "small": os.path.join(MODELS_DIR, "model_file_name_small.json"),
+}
+
+# model size each step runs on by default, short classification-like steps go to the small model
+step_model_sizes = {
+    "generate_roadmap": "big",
+    "generate_response": "big",
+    "generate_response_with_context": "big",
+    "summarize_conversation": "big",
+    "decide_to_respond_or_use_tool": "small",
+    "return_relevant_tags": "small",
+    "finished_with_subdocs": "small",
+    "generate_tags": "small",
+}
+
+model_context_size = 30000
 
 subdoc_word_limit = 1500
+# documents are ingested in windows of at most this many tokens, leaving room in the context for prompts, subdocs and output
+document_window_tokens = 10000
+# speculative decoding for answer generation: None, "prompt_lookup" (drafts by matching n-grams of the prompt, which answers
+# quoting the retrieved context repeat) or "draft_model" (drafts with the small model)
+speculative_decoding = None
+draft_tokens = 10
+# steps that run on a separate answer instance while speculative decoding is on. Verifying drafts makes llama_cpp keep the logits
+# of every context position (n_ctx x n_vocab floats), which only that instance pays for
+answer_steps = ["generate_response", "generate_response_with_context"]
+# length of the rolling summary older chat turns are folded into
+conversation_summary_tokens = 600
+# paragraphs starting like a heading, where a window that is already half full is ended. Only the keywords ignore case, a
+# numbered heading needs a capitalized title so numbered sentences ("1. the value is...") don't count
+heading_pattern = re.compile(r"(#{1,6}\s|(?i:chapter|section|part)\s+\w+|\d+(\.\d+)*\.?\s+[A-Z])")
+# model instances generating sub-documents side by side in parallel ingest, capped by the core count
+subdoc_parallel_instances = 4
+
+# tag token sequences are persisted per database here, compiled relevant tag grammars are kept in memory per candidate set
+TOKEN_CACHE_DIR = 'databases/tokens'
+grammar_cache_size = 32
+# most tags (primary plus associated) return_relevant_tags may produce
+relevant_tag_limit = 5
 
 """
 The LLMHandler class is a wrapper for the LLM model. It provides methods to interact with the model relevant to the larger agentic database use case
 such as generating tags, generating roadmaps, and generating responses with context. The class also handles the downloading of the model and
 the creation of the model object. The model object is a singleton object that is created once and then reused for all subsequent requests. 
+There is a big and a small model, each step runs on the size configured for it in step_models (see step_model_sizes): answers, roadmaps and
+sub-documents use the big one, short classification-like steps the small one. With a residency handler both are registered ("llm" and
+"llm_small") and share its RAM budget. With speculative decoding on, answers run on a separate instance of their size built for drafting
+("llm_answer", "llm_small_answer"), so the other steps don't keep per-position logits; its residency estimate includes that buffer.
 A function to unload the model from memory is made available to free up resources when the model is no longer needed or when other modes of the 
 application are being used. 
 
 Grammars in llama are on a token basis and so the grammar needs to be constructed from the tokens that are generated from the model.
+Token sequences only depend on the model, so they are tokenized once per tag and kept in a per-database token cache
+(<TOKEN_CACHE_DIR>/<database>-tokens.db) that is cleared when the model file changes.
+
+The model is given a PromptCacheHandler as its llama cache, so calls sharing a long prefix with a recent call (the same document
+across sub-document calls, the same system prompt across queries) only evaluate what comes after it. Calls starting with a
+fixed prompt (roadmaps, tag generation, relevant tag selection) also snapshot the model state to disk after their first run,
+keyed by the model and the prompt hash, and load it back in later sessions.
 The module provides the following functions:
 
-- get_model(): llama_cpp.Llama - returns the llama model object
-- release_model(): None - releases the llama model object from memory
+- get_model(size: str = "big"): llama_cpp.Llama - returns the llama model object of the given size
+- use_model(size: str = "big"): ContextManager[llama_cpp.Llama] - yields the model of the given size, pinned in the residency handler (if
+    one is used) so it isn't evicted while generating
+- get_step_model(step: str): llama_cpp.Llama - returns the model configured for the step
+- use_answer_model(size: str = "big"): ContextManager[llama_cpp.Llama] - yields the model answers of the given size run on, pinned like
+    use_model: the answer instance built for drafting with speculative decoding on, the shared instance without it
+- set_step_model(step: str, size: str): None - routes the step to the model of the given size. Answers can't run on the small model
+    while it drafts for them
+- set_speculative_decoding(mode: str | None): None - sets the speculative decoding used for answers, see speculative_decoding. The answer
+    instances are unloaded when the mode changes, since llama_cpp only verifies drafts with a model built for them
+- get_generation_stats(): Dict[str, Dict[str, float]] - returns answers, generated tokens and seconds spent per speculative decoding
+    mode ("none" without it), to compare tokens/sec with and without it
+- get_sampling(): Dict[str, float] - returns the sampling settings of the roadmap and relevance steps, greedy when deterministic is set
+    (their outputs are memoized then, so the same input has to give the same output)
+- release_model(size: str = None): None - releases the llama model object (every size if None) from memory, or hands it back to the
+    residency handler if one is used
 - get_token_count(text: str): int - returns the number of tokens in the text
-- get_token_sets(tags_actual: List[str]): List[List[str]] - returns a list of token sets for the tags
-- construct_grammar_from_token_sets(token_sets: List[List[str]]): str - returns the grammar text constructed from the token sets
-- return_relevant_tags(text: str, tags_actual: List[str]): List[str] - returns the relevant tags for the text
+- split_document(text: str, max_tokens: int = document_window_tokens): Iterator[str] - yields windows of the text of at most max_tokens
+    tokens, made of whole paragraphs where possible and ending before headings once half full. Paragraphs too long for a window are
+    split by sentences, and sentences by tokens
+- get_prompt_cache_stats(): Dict[str, Dict[str, int]] - returns the prompt cache hits, misses, reused prompt tokens and snapshot loads and
+    saves per model size, answer instances under "<size>_answer"
+- get_token_sets(tags_actual: List[str], database_title: str | List[str] = None): List[List[str]] - returns a list of token sets for the tags,
+    cached in memory and, when database titles are given, in each database's token cache
+- construct_grammar_from_token_sets(token_sets: List[List[str]], max_tags: int = relevant_tag_limit): str - returns the grammar text
+    constructed from the token sets. Tags are laid out as a trie of rules sharing their token prefixes. The first tag (primary) can be
+    any candidate, the associated tags after it must follow trie order, so none of them repeats and at most max_tags tags are produced.
+    The primary tag may reappear among the associated ones and is dropped when the output is parsed. "nothing" is always allowed.
+- get_relevant_tag_grammar(tags_actual: List[str], database_title: str | List[str] = None): llama_cpp.LlamaGrammar - returns the compiled
+    grammar for the candidate tags, cached by the hash of the candidate set
+- delete_token_cache(database_title: str): None - deletes the token cache of a database
+- return_relevant_tags(text: str, tags_actual: List[str], database_title: str | List[str] = None): List[str] - returns the relevant tags for the text
 - generate_tags(text: str): List[str] - returns the tags for the text
 - generate_roadmap(text: str): List[List[str, str]] - returns the roadmap for the text
-- generate_response_with_context(conversation_history: List[Dict[str, str]], context: List[str]): str - returns the response with context
+- generate_response_with_context(conversation_history: List[Dict[str, str]], context: List[str], on_token: Callable = None): str - returns the
+    response with context. With on_token, the response is streamed and on_token(text) is called with every token as it is generated
 - finished_with_subdocs(messages: List[Dict[str, str]], subject_list: List[str]): bool - returns whether the subdocs are finished
-- break_up_and_summarize_text(text: str): List[Dict[str, str]] - returns the subdocs for the text
-- generate_response(conversation_history: List[Dict[str, str]]): str - returns the response for the conversation history
+- list_subjects(text: str, known_subjects: List[str] = None): List[Dict[str, str]] - returns the subjects of the text, reusing the names of
+    known subjects found earlier in the same document
+- break_up_and_summarize_text(text: str, parallel: bool = False, is_covered: Callable = None): List[Dict[str, str]] - returns the subdocs for the text.
+    The text is processed one window of split_document at a time: subjects are listed per window, merged into the document's subject
+    list, and the window's subdocs are generated from that window alone.
+    Sequentially, each subdoc sees the previous ones and the model decides after each one whether the subjects are covered. In parallel,
+    every subject's subdoc is generated independently from the cached document prefix on a pool of model instances, and subjects for which
+    is_covered(subject, subdocs) holds are skipped
+- generate_response(conversation_history: List[Dict[str, str]], on_token: Callable = None): str - returns the response for the conversation
+    history, streamed to on_token like generate_response_with_context
+- summarize_conversation(previous_summary: str | None, messages: List[Dict[str, str]], max_tokens: int = conversation_summary_tokens): str -
+    returns a summary of at most max_tokens tokens of the messages that continues the previous summary, used to compact the chat history
 - decide_to_respond_or_use_tool(conversation_history: List[Dict[str, str]]): str - returns whether to respond or use the tool
 """
 
@@ -123,103 +226,648 @@ subdoc_schema = {
 }
 
 
+class SmallModelDraft:
+
+    # llama_cpp draft model protocol: called with the tokens so far, returns the tokens it predicts next
+    def __init__(self, get_model, num_pred_tokens=draft_tokens):
+        self.get_model = get_model
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        model = self.get_model()
+        draft = []
+
+        # Greedy, and the small model keeps its evaluated prefix between calls, so each call only evaluates the new tokens
+        for token in model.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            if token == model.token_eos() or len(draft) >= self.num_pred_tokens:
+                break
+            draft.append(token)
+
+        return np.array(draft, dtype=np.intc)
+
+
 class LLMHandler:
 
-    # singleton model
-    _model = None
+    # singleton model per size
+    _models = None
     generic_tag_grammar = None
 
-    def __init__(self):
-        if not os.path.exists(model_file_name):
-            print("Downloading model...")
-            llama_large_location = hf_hub_download(
-                repo_id="lmstudio-community/Meta-Llama-3.1-8B-Instruct-GGUF",
-                filename="Meta-Llama-3.1-8B-Instruct-Q3_K_L.gguf",
-                cache_dir=MODELS_DIR,
+    def __init__(self, residency=None):
+        self._models = {}
+        self.step_models = dict(step_model_sizes)
+        self.deterministic = False
+        self.speculative_decoding = speculative_decoding
+        self._draft_models = {}
+        self._answer_models = {}
+        self._vocab_sizes = {}
+        self.generation_stats = {}
+
+        # tag -> token sequence for the model in model_key (the one picking relevant tags), and the databases whose token cache was read into it
+        self.model_key = None
+        self._token_sets = {}
+        self._loaded_token_caches = set()
+        self._grammar_cache = OrderedDict()
+        # llama states of recent prompts per model size, kept across model reloads since they stay valid for the same model
+        self.prompt_caches = {size: PromptCacheHandler() for size in model_sources}
+        self.prompt_cache_keys = {}
+        self._subdoc_models = []
+
+        # when a residency handler is given it decides when the models are loaded and evicted
+        self.residency = residency
+        # the models are downloaded and the grammar compiled on first use, not at construction
+        if self.residency is not None:
+            for size in model_sources:
+                self.residency.register(
+                    self.get_residency_name(size),
+                    lambda size=size: self.load_model(size),
+                    lambda size=size: self.unload_model(size),
+                    lambda size=size: self.estimate_model_size(size),
+                )
+                self.residency.register(
+                    self.get_answer_residency_name(size),
+                    lambda size=size: self.load_answer_model(size),
+                    lambda size=size: self.unload_answer_model(size),
+                    lambda size=size: self.estimate_answer_model_size(size),
+                )
+            self.residency.register(
+                "llm_subdoc", self.load_subdoc_models, self.unload_subdoc_models, self.estimate_subdoc_models_size
             )
 
-            model_json = {"model_file": llama_large_location}
-            with open(model_file_name, "w") as f:
-                json.dump(model_json, f)
-        else:
-            print("Model already downloaded.")
-        with contextlib.redirect_stdout(
-            open(os.devnull, "w")
-        ), contextlib.redirect_stderr(open(os.devnull, "w")):
-            self.generic_tag_grammar = llama_cpp.LlamaGrammar.from_string(
-                generic_tag_grammar_text
-            )
+    def get_residency_name(self, size):
+        return "llm" if size == "big" else f"llm_{size}"
 
-    # TODO: add big vs small model selection and figure out where smaller models could be used in functionality.
     def get_model(self, size="big"):
-        if self._model is None:
-            with open(model_file_name, "r") as f:
-                model_json = json.load(f)
-            self._model = llama_cpp.Llama(
-                model_json["model_file"],
-                n_gpu_layers=-1,
-                n_ctx=30000,
-                flash_attn=True,
-                type_k=8,
-                type_v=8,
-                verbose=False,
+        if self.residency is not None:
+            return self.residency.get(self.get_residency_name(size))
+        return self.load_model(size)
+
+    @contextlib.contextmanager
+    def use_model(self, size="big"):
+        # Pinned so that loading another model meanwhile (the draft, the small model) can't evict it mid-generation
+        if self.residency is None:
+            yield self.load_model(size)
+            return
+
+        name = self.get_residency_name(size)
+        model = self.residency.pin(name)
+        try:
+            yield model
+        finally:
+            self.residency.unpin(name)
+
+    def get_step_size(self, step):
+        return self.step_models.get(step, "big")
+
+    def get_step_model(self, step):
+        return self.get_model(self.get_step_size(step))
+
+    def set_step_model(self, step, size):
+        if size not in model_sources:
+            raise ValueError(f"Model size must be one of {list(model_sources)}")
+        # The small model can't draft for itself
+        if step in answer_steps and size == "small" and self.speculative_decoding == "draft_model":
+            raise ValueError("Answers can't run on the small model while it drafts them, change the speculative decoding first")
+        self.step_models[step] = size
+
+    def set_speculative_decoding(self, mode):
+        if mode not in [None, "prompt_lookup", "draft_model"]:
+            raise ValueError("Speculative decoding must be None, 'prompt_lookup' or 'draft_model'")
+        if mode == "draft_model" and "small" in self.get_answer_sizes():
+            raise ValueError("The small model can't draft answers that run on it, route the answer steps to the big model first")
+        if mode == self.speculative_decoding:
+            return
+        # Answer instances were built for the previous mode, they are built again on next use
+        for size in model_sources:
+            if self.residency is not None:
+                self.residency.evict(self.get_answer_residency_name(size))
+            else:
+                self.unload_answer_model(size)
+        self.speculative_decoding = mode
+
+    def get_answer_sizes(self):
+        return {self.get_step_size(step) for step in answer_steps}
+
+    def get_answer_residency_name(self, size):
+        return f"{self.get_residency_name(size)}_answer"
+
+    @contextlib.contextmanager
+    def use_answer_model(self, size="big"):
+        # Without speculative decoding answers share the instance of the other steps
+        if self.speculative_decoding is None:
+            with self.use_model(size) as model:
+                yield model
+            return
+
+        if self.residency is None:
+            yield self.load_answer_model(size)
+            return
+
+        name = self.get_answer_residency_name(size)
+        model = self.residency.pin(name)
+        try:
+            yield model
+        finally:
+            self.residency.unpin(name)
+
+    def load_answer_model(self, size="big"):
+        if size not in self._answer_models:
+            self._answer_models[size] = self.create_model(size, draft_model=self.get_draft_model())
+
+        return self._answer_models[size]
+
+    def unload_answer_model(self, size="big"):
+        self._answer_models.pop(size, None)
+
+    def get_vocab_size(self, size="big"):
+        if size not in self._vocab_sizes:
+            # Only the vocabulary is read, not the weights
+            vocab_model = llama_cpp.Llama(self.get_model_file(size), vocab_only=True, verbose=False)
+            self._vocab_sizes[size] = vocab_model.n_vocab()
+        return self._vocab_sizes[size]
+
+    def estimate_answer_model_size(self, size="big"):
+        # The weights are memory-mapped and shared with the other instance, this one adds its KV cache, scratch buffers and the
+        # float32 logits of every context position
+        return int(os.path.getsize(self.get_model_file(size)) * 0.5) + model_context_size * self.get_vocab_size(size) * 4
+
+    def get_draft_model(self):
+        if self.speculative_decoding is None:
+            return None
+
+        if self.speculative_decoding not in self._draft_models:
+            if self.speculative_decoding == "prompt_lookup":
+                from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+                self._draft_models["prompt_lookup"] = LlamaPromptLookupDecoding(num_pred_tokens=draft_tokens)
+            else:
+                self._draft_models["draft_model"] = SmallModelDraft(lambda: self.get_model("small"))
+
+        return self._draft_models[self.speculative_decoding]
+
+    def create_answer(self, model, messages, on_token=None):
+        # Callers pin the answer model, the small model drafting for it is pinned too so neither is evicted mid-answer
+        with self.use_model("small") if self.speculative_decoding == "draft_model" else contextlib.nullcontext():
+            return self.create_answer_with_draft(model, messages, on_token)
+
+    def create_answer_with_draft(self, model, messages, on_token=None):
+        # The answer instance was built with the draft model, grammar constrained steps run on the other instance token by token
+        start = time.time()
+        if on_token is None:
+            response = model.create_chat_completion(messages=messages)
+            answer = response["choices"][0]["message"]["content"]
+            completion_tokens = response["usage"]["completion_tokens"]
+        else:
+            # Every streamed chunk carries one token, handed on as soon as it is sampled
+            answer, completion_tokens = "", 0
+            for chunk in model.create_chat_completion(messages=messages, stream=True):
+                token = chunk["choices"][0]["delta"].get("content") if chunk["choices"] else None
+                if not token:
+                    continue
+                answer += token
+                completion_tokens += 1
+                on_token(token)
+
+        stats = self.generation_stats.setdefault(
+            self.speculative_decoding or "none", {"answers": 0, "tokens": 0, "seconds": 0.0}
+        )
+        stats["answers"] += 1
+        stats["tokens"] += completion_tokens
+        stats["seconds"] += time.time() - start
+
+        return answer
+
+    def get_generation_stats(self):
+        return {mode: dict(stats) for mode, stats in self.generation_stats.items()}
+
+    def get_sampling(self):
+        return {"temperature": 0.0} if self.deterministic else {}
+
+    def download_model(self, size="big"):
+        if not os.path.exists(model_file_names[size]):
+            print(f"Downloading {size} model...")
+            repo_id, filename = model_sources[size]
+            model_location = huggingface_hub.hf_hub_download(
+                repo_id=repo_id,
+                filename=filename,
+                cache_dir=MODELS_DIR,
             )
 
-        return self._model
+            model_json = {"model_file": model_location}
+            with open(model_file_names[size], "w") as f:
+                json.dump(model_json, f)
 
-    def release_model(self):
-        if self._model is not None:
-            del self._model
-            self._model = None
+    def get_model_file(self, size="big"):
+        self.download_model(size)
+        with open(model_file_names[size], "r") as f:
+            return json.load(f)["model_file"]
+
+    def get_generic_tag_grammar(self):
+        if self.generic_tag_grammar is None:
+            with contextlib.redirect_stdout(
+                open(os.devnull, "w")
+            ), contextlib.redirect_stderr(open(os.devnull, "w")):
+                self.generic_tag_grammar = llama_cpp.LlamaGrammar.from_string(
+                    generic_tag_grammar_text
+                )
+        return self.generic_tag_grammar
+
+    def create_model(self, size="big", n_threads=None, draft_model=None):
+        # A draft model given at construction makes llama_cpp keep the logits of every position, which verifying drafts needs
+        model = llama_cpp.Llama(
+            self.get_model_file(size),
+            n_gpu_layers=-1,
+            n_ctx=model_context_size,
+            n_threads=n_threads,
+            flash_attn=True,
+            type_k=8,
+            type_v=8,
+            draft_model=draft_model,
+            verbose=False,
+        )
+        # States only depend on the model and context settings, so every instance of a size shares its prompt cache. States of an answer
+        # instance also hold the logits of every position and can't be loaded into the other instance, they get a cache of their own
+        cache_name = size if draft_model is None else f"{size}_answer"
+        if cache_name not in self.prompt_caches:
+            self.prompt_caches[cache_name] = PromptCacheHandler()
+
+        # States of another model file can't be loaded into this one
+        model_key = self.get_model_key(size)
+        if self.prompt_cache_keys.get(cache_name) != model_key:
+            self.prompt_caches[cache_name].clear()
+            self.prompt_cache_keys[cache_name] = model_key
+
+        model.set_cache(self.prompt_caches[cache_name])
+        return model
+
+    def load_model(self, size="big"):
+        if size not in self._models:
+            self._models[size] = self.create_model(size)
+
+        return self._models[size]
+
+    def release_model(self, size=None):
+        sizes = [size] if size is not None else list(model_sources)
+        for size in sizes:
+            if self.residency is not None:
+                self.residency.release(self.get_residency_name(size))
+                self.residency.release(self.get_answer_residency_name(size))
+            else:
+                self.unload_model(size)
+                self.unload_answer_model(size)
+
+    def unload_model(self, size="big"):
+        self._models.pop(size, None)
+
+    def get_subdoc_instance_count(self):
+        return max(1, min(subdoc_parallel_instances, os.cpu_count() or 1))
+
+    def get_subdoc_models(self):
+        # Pinned until release_subdoc_models, coverage checks load the embedding model while the instances generate
+        if self.residency is not None:
+            return self.residency.pin("llm_subdoc")
+        return self.load_subdoc_models()
+
+    def load_subdoc_models(self):
+        if not self._subdoc_models:
+            count = self.get_subdoc_instance_count()
+            # The instances run at the same time, so they split the cores between them
+            threads = max(1, (os.cpu_count() or 1) // count)
+            self._subdoc_models = [self.create_model("big", n_threads=threads) for _ in range(count)]
+
+        return self._subdoc_models
+
+    def release_subdoc_models(self):
+        if self.residency is not None:
+            self.residency.unpin("llm_subdoc")
+            return
+        self.unload_subdoc_models()
+
+    def unload_subdoc_models(self):
+        self._subdoc_models = []
+
+    def estimate_subdoc_models_size(self):
+        # The weights are memory-mapped and shared between instances, each one adds its own KV cache and scratch buffers
+        return int(os.path.getsize(self.get_model_file("big")) * 0.5 * self.get_subdoc_instance_count())
+
+    def estimate_model_size(self, size="big"):
+        # weights plus room for the KV cache and scratch buffers
+        return int(os.path.getsize(self.get_model_file(size)) * 1.5)
 
     def get_token_count(self, text):
         model = self.get_model()
         text_bytes = text.encode("utf-8")
         return len(model.tokenize(text_bytes))
 
-    def get_token_sets(self, tags_actual):
-        model = self.get_model()
-        token_sets = []
+    def iter_paragraphs(self, text):
+        start = 0
+        for separator in re.finditer(r"\n\s*\n", text):
+            yield text[start:separator.start()]
+            start = separator.end()
+        yield text[start:]
+
+    def split_paragraph(self, paragraph, max_tokens):
+        # A paragraph too long for a window is regrouped by sentences, a sentence too long is cut by tokens
+        chunk, chunk_tokens = [], 0
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            sentence_tokens = self.get_token_count(sentence)
+            if sentence_tokens > max_tokens:
+                model = self.get_model()
+                tokens = model.tokenize(sentence.encode("utf-8"), add_bos=False)
+                pieces = [
+                    (model.detokenize(tokens[i:i + max_tokens]).decode("utf-8", errors="ignore"), len(tokens[i:i + max_tokens]))
+                    for i in range(0, len(tokens), max_tokens)
+                ]
+            else:
+                pieces = [(sentence, sentence_tokens)]
+
+            for piece, piece_tokens in pieces:
+                if chunk and chunk_tokens + piece_tokens > max_tokens:
+                    yield " ".join(chunk), chunk_tokens
+                    chunk, chunk_tokens = [], 0
+                chunk.append(piece)
+                chunk_tokens += piece_tokens
+
+        if chunk:
+            yield " ".join(chunk), chunk_tokens
+
+    def split_document(self, text, max_tokens=document_window_tokens):
+        # Documents that fit are passed on untouched
+        if self.get_token_count(text) <= max_tokens:
+            yield text
+            return
+
+        window, window_tokens = [], 0
+
+        for paragraph in self.iter_paragraphs(text):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
 
+            paragraph_tokens = self.get_token_count(paragraph)
+            if paragraph_tokens > max_tokens:
+                pieces = list(self.split_paragraph(paragraph, max_tokens))
+            else:
+                pieces = [(paragraph, paragraph_tokens)]
+
+            for piece, piece_tokens in pieces:
+                # Sections stay together where they can, a heading ends a window that is already half full
+                starts_section = heading_pattern.match(piece) is not None
+                if window and (
+                    window_tokens + piece_tokens > max_tokens
+                    or (starts_section and window_tokens > max_tokens // 2)
+                ):
+                    yield "\n\n".join(window)
+                    window, window_tokens = [], 0
+                window.append(piece)
+                window_tokens += piece_tokens
+
+        if window:
+            yield "\n\n".join(window)
+
+    def get_model_key(self, size="big"):
+        # The model file path and size identify the model the cached tokens and states belong to
+        model_file = self.get_model_file(size)
+        return f"{os.path.basename(model_file)}:{os.path.getsize(model_file)}"
+
+    def check_model_key(self):
+        # Token sets and grammars belong to the model that picks relevant tags
+        model_key = self.get_model_key(self.get_step_size("return_relevant_tags"))
+        if model_key != self.model_key:
+            self.model_key = model_key
+            self._token_sets = {}
+            self._loaded_token_caches = set()
+            self._grammar_cache = OrderedDict()
+
+    def load_prompt_snapshot(self, size, static_prompt):
+        self.prompt_caches[size].load_snapshot(self.prompt_cache_keys[size], static_prompt)
+
+    def save_prompt_snapshot(self, model, size, static_prompt):
+        self.prompt_caches[size].save_snapshot(self.prompt_cache_keys[size], static_prompt, model.save_state)
+
+    def get_prompt_cache_stats(self):
+        return {size: prompt_cache.get_stats() for size, prompt_cache in self.prompt_caches.items()}
+
+    def connect_token_cache(self, database_title):
+        if not os.path.exists(TOKEN_CACHE_DIR):
+            os.makedirs(TOKEN_CACHE_DIR)
+
+        conn = sqlite3.connect(os.path.join(TOKEN_CACHE_DIR, f"{database_title}-tokens.db"))
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS token_sets (
+            tag TEXT PRIMARY KEY,
+            tokens TEXT NOT NULL
+        )''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS metadata (
+            model_key TEXT
+        )''')
+
+        # Tokens cached for a different model are useless, start over
+        cursor.execute('SELECT model_key FROM metadata')
+        row = cursor.fetchone()
+        if row is None or row[0] != self.model_key:
+            cursor.execute('DELETE FROM token_sets')
+            cursor.execute('DELETE FROM metadata')
+            cursor.execute('INSERT INTO metadata (model_key) VALUES (?)', (self.model_key,))
+        conn.commit()
+
+        return conn
+
+    def delete_token_cache(self, database_title):
+        cache_path = os.path.join(TOKEN_CACHE_DIR, f"{database_title}-tokens.db")
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        self._loaded_token_caches.discard(database_title)
+
+    def get_token_sets(self, tags_actual, database_title=None):
+        model = self.get_step_model("return_relevant_tags")
+        self.check_model_key()
+
+        database_titles = database_title if isinstance(database_title, (list, tuple)) else [database_title] if database_title else []
+
+        # Read each database's persisted tokens once per model
+        for title in database_titles:
+            if title in self._loaded_token_caches:
+                continue
+            conn = self.connect_token_cache(title)
+            cursor = conn.cursor()
+            cursor.execute('SELECT tag, tokens FROM token_sets')
+            for tag, tokens in cursor.fetchall():
+                self._token_sets.setdefault(tag, json.loads(tokens))
+            conn.close()
+            self._loaded_token_caches.add(title)
+
+        new_token_sets = {}
         for tag in tags_actual:
+            if tag in self._token_sets or tag in new_token_sets:
+                continue
+
             # Tokenize the tag
             tokenized_tag = model.tokenize(tag.encode("utf-8"))
 
             # Now process the tokenized tag as a sequence of tokens
-            detokenized_tokens = [
+            new_token_sets[tag] = [
                 model.detokenize([token]).decode("utf-8") for token in tokenized_tag
             ]
 
-            # Append the list of tokens to the token_sets list
-            token_sets.append(detokenized_tokens)
-
-        return token_sets
-
-    def construct_grammar_from_token_sets(self, token_sets):
-        # Create grammar rule components for each tokenized tag
-        tag_grammar_parts = []
+        if new_token_sets:
+            self._token_sets.update(new_token_sets)
+            for title in database_titles:
+                conn = self.connect_token_cache(title)
+                conn.executemany(
+                    'INSERT OR REPLACE INTO token_sets (tag, tokens) VALUES (?, ?)',
+                    [(tag, json.dumps(tokens)) for tag, tokens in new_token_sets.items()],
+                )
+                conn.commit()
+                conn.close()
+
+        return [list(self._token_sets[tag]) for tag in tags_actual]
+
+    def build_token_trie(self, token_sets):
+        # Nodes are {"tokens": [...], "terminal": bool, "children": [...]}, identical token sets collapse into one path
+        root = {"tokens": [], "terminal": False, "children": {}}
         for token_set in token_sets:
-            # Represent each token in the set, ensuring we use explicit token breaks
-            tag_rule = " ".join([f'"{token}"' for token in token_set])
-            tag_grammar_parts.append(f"({tag_rule})")
+            node = root
+            for token in token_set:
+                # BOS and other special tokens detokenize to nothing
+                if not token:
+                    continue
+                node = node["children"].setdefault(token, {"tokens": [token], "terminal": False, "children": {}})
+            if node is not root:
+                node["terminal"] = True
+
+        def compress(node):
+            children = [compress(child) for child in node["children"].values()]
+            # A non-terminal node with a single child is merged into that child's edge
+            while not node["terminal"] and len(children) == 1 and node is not root:
+                child = children[0]
+                node = {"tokens": node["tokens"] + child["tokens"], "terminal": child["terminal"], "children": {}}
+                children = child["compressed_children"]
+            node["compressed_children"] = children
+            return node
+
+        return compress(root)
+
+    def construct_grammar_from_token_sets(self, token_sets, max_tags=relevant_tag_limit):
+        root = self.build_token_trie(token_sets)
+
+        # Number the trie nodes in depth-first order, which is the order associated tags have to follow
+        nodes = []
+
+        def number(node, parent, following):
+            node["id"] = len(nodes)
+            node["parent"] = parent
+            node["following"] = following
+            nodes.append(node)
+            children = node["compressed_children"]
+            for i, child in enumerate(children):
+                number(child, node, children[i + 1:])
+
+        number(root, None, [])
+
+        def literal(node):
+            return " ".join(f'"{token}"' for token in node["tokens"])
+
+        # A new tag entering a subtree has to spell the shared prefix down to it first, q<id> spells it once per node
+        def prefix(node):
+            return f"q{node['id']} " if node["parent"] is not None else ""
+
+        rules = []
+
+        # p<id>: the primary tag, any candidate
+        for node in nodes[1:]:
+            kids = [f"p{child['id']}" for child in node["compressed_children"]]
+            if not kids:
+                rules.append(f"p{node['id']} ::= {literal(node)}")
+            else:
+                rules.append(f"p{node['id']} ::= {literal(node)} ({' | '.join(kids)}){'?' if node['terminal'] else ''}")
+
+            if node["compressed_children"]:
+                rules.append(f"q{node['id']} ::= {prefix(node['parent'])}{literal(node)}")
+
+        # Whether any tag comes after the node's whole subtree
+        for node in nodes:
+            node["has_after"] = node["parent"] is not None and bool(
+                node["following"] or (node["parent"]["parent"] is not None and node["parent"]["has_after"])
+            )
 
-        # Join the tag rules with | for alternation
-        grammar_text = f"""
-        root ::= tags
-        tags ::= tag ("," tag)*
-        tag ::= {' | '.join(tag_grammar_parts)}
-        """
+        # For j tags still allowed:
+        # s<id>-<j>: the rest of a tag in the subtree of the node, then the tags after it
+        # n<id>-<j>: a tag after the node's own tag (its descendants, then everything after its subtree)
+        # a<id>-<j>: a tag after the node's whole subtree, chained sibling by sibling so every rule stays constant size
+        # Only strictly later tags can follow, so no tag repeats and at most max_tags - 1 associated tags fit.
+        for j in range(1, max_tags):
+            for node in nodes[1:]:
+                if not node["has_after"]:
+                    continue
+                if node["following"]:
+                    sibling = node["following"][0]
+                    alternatives = [f"{prefix(node['parent'])}s{sibling['id']}-{j}"]
+                    if sibling["has_after"]:
+                        alternatives.append(f"a{sibling['id']}-{j}")
+                else:
+                    alternatives = [f"a{node['parent']['id']}-{j}"]
+                rules.append(f"a{node['id']}-{j} ::= {' | '.join(alternatives)}")
+
+            # Next tags follow the primary with max_tags - 1 allowed, and finished associated tags with fewer
+            for node in nodes:
+                if (node is root) != (j == max_tags - 1) or (node is not root and not node["terminal"]):
+                    node.setdefault("has_next", {})[j] = False
+                    continue
+                next_alternatives = []
+                if node["compressed_children"]:
+                    child = node["compressed_children"][0]
+                    next_alternatives.append(f"{prefix(node)}s{child['id']}-{j}")
+                    if child["has_after"]:
+                        next_alternatives.append(f"a{child['id']}-{j}")
+                elif node["has_after"]:
+                    next_alternatives.append(f"a{node['id']}-{j}")
+                if next_alternatives:
+                    rules.append(f"n{node['id']}-{j} ::= {' | '.join(next_alternatives)}")
+                node.setdefault("has_next", {})[j] = bool(next_alternatives)
+
+        for j in range(1, max_tags):
+            for node in nodes[1:]:
+                alternatives = [f"s{child['id']}-{j}" for child in node["compressed_children"]]
+                if node["terminal"] and j > 1 and node["has_next"][j - 1]:
+                    alternatives.append(f'"," n{node["id"]}-{j - 1}')
+
+                if not alternatives:
+                    rules.append(f"s{node['id']}-{j} ::= {literal(node)}")
+                else:
+                    rules.append(f"s{node['id']}-{j} ::= {literal(node)} ({' | '.join(alternatives)}){'?' if node['terminal'] else ''}")
+
+        primary = " | ".join(f"p{child['id']}" for child in root["compressed_children"])
+        if not primary:
+            return 'root ::= "nothing"'
+
+        associated = ""
+        if max_tags > 1 and root["has_next"][max_tags - 1]:
+            associated = f' ("," n{root["id"]}-{max_tags - 1})?'
+
+        grammar_text = "\n".join(
+            [f'root ::= "nothing" | tags', f"tags ::= primary{associated}", f"primary ::= {primary}"] + rules
+        )
 
         return grammar_text
 
-    def return_relevant_tags(self, text, tags_actual):
-        model = self.get_model()
+    def get_relevant_tag_grammar(self, tags_actual, database_title=None):
+        self.get_step_model("return_relevant_tags")
+        self.check_model_key()
+
+        # The grammar only depends on the set of candidates, not their order
+        candidates = sorted(set(tags_actual))
+        grammar_key = hashlib.sha1("\n".join(candidates).encode("utf-8")).hexdigest()
 
-        # Ensure tags_actual is a list of token sets and include a "nothing" tag option
-        token_sets = self.get_token_sets(tags_actual)  # Split tags into tokens
-        token_sets.append(["nothing"])  # Add the "nothing" tag
+        if grammar_key in self._grammar_cache:
+            self._grammar_cache.move_to_end(grammar_key)
+            return self._grammar_cache[grammar_key]
 
-        # Generate the grammar from token sets
+        token_sets = self.get_token_sets(candidates, database_title)  # Split tags into tokens
+
+        # Generate the grammar from token sets, it includes the "nothing" option
         grammar_text = self.construct_grammar_from_token_sets(token_sets)
 
         with contextlib.redirect_stdout(
@@ -227,6 +875,18 @@ class LLMHandler:
         ), contextlib.redirect_stderr(open(os.devnull, "w")):
             token_grammar = llama_cpp.LlamaGrammar.from_string(grammar_text)
 
+        self._grammar_cache[grammar_key] = token_grammar
+        if len(self._grammar_cache) > grammar_cache_size:
+            self._grammar_cache.popitem(last=False)
+
+        return token_grammar
+
+    def return_relevant_tags(self, text, tags_actual, database_title=None):
+        size = self.get_step_size("return_relevant_tags")
+        model = self.get_model(size)
+
+        token_grammar = self.get_relevant_tag_grammar(tags_actual, database_title)
+
         prompt = """Given the following text and a list of possibly relevant valid tags in our database,
         return only the tag or tags that are relevant to the prompt being asked and may point towards documents in the database 
         that would help answer the prompt.  You are not trying to make a judgement call or answer the question. You should return a 
@@ -245,7 +905,9 @@ class LLMHandler:
             + "\nThese are the actually relevant tags: \n"
         )
 
-        output = model(constructed_prompt, grammar=token_grammar)
+        self.load_prompt_snapshot(size, prompt)
+        output = model(constructed_prompt, grammar=token_grammar, **self.get_sampling())
+        self.save_prompt_snapshot(model, size, prompt)
 
         output_str = output["choices"][0]["text"]
 
@@ -263,7 +925,8 @@ class LLMHandler:
         return tags_trimmed
 
     def generate_tags(self, text):
-        model = self.get_model()
+        size = self.get_step_size("generate_tags")
+        model = self.get_model(size)
         prompt = """Given the following text, generate a tag or a list of tags that describe subjects or the contents of the text. These 
         tags will be metadata associated with the text within a database and should fully describe subjects and concepts present in the text.
         The list should be comma-delimited.\nText\n"""
@@ -274,7 +937,9 @@ class LLMHandler:
             + "\nrelevant tags describing the contents, subjects, and concepts in the text:\n"
         )
 
-        output = model(constructed_prompt, grammar=self.generic_tag_grammar)
+        self.load_prompt_snapshot(size, prompt)
+        output = model(constructed_prompt, grammar=self.get_generic_tag_grammar())
+        self.save_prompt_snapshot(model, size, prompt)
 
         output_str = output["choices"][0]["text"]
 
@@ -283,7 +948,8 @@ class LLMHandler:
         return text_tags
 
     def generate_roadmap(self, text):
-        model = self.get_model()
+        size = self.get_step_size("generate_roadmap")
+        model = self.get_model(size)
         system_prompt = """You are a knowledge base system orchestrator module. You are provided a prompt or query, you do not answer the prompt. 
         You are responsible for creating a functional set of steps to retrieve information from the knowledge base to best answer the last given prompt.
         More context than the last given prompt may be submitted to you to give context, but don't repititiously create steps for anything other than the final user's query.
@@ -302,31 +968,28 @@ class LLMHandler:
             {"role": "user", "content": text},
         ]
 
+        self.load_prompt_snapshot(size, system_prompt)
         roadmap_response, assistant_content = PrintHandler.get_structured_output(
-            model, messages, roadmap_schema, verbose=True
+            model, messages, roadmap_schema, verbose=True, sampling=self.get_sampling()
         )
+        self.save_prompt_snapshot(model, size, system_prompt)
 
         steps = roadmap_response["steps"]
 
         roadmap = [[step["query"].split(","), step["explanation"]] for step in steps]
         return roadmap
 
-    def generate_response_with_context(self, conversation_history, context):
-        model = self.get_model()
-
+    def generate_response_with_context(self, conversation_history, context, on_token=None):
         context_str = "\n".join(context)
         combined_text = "\nRetrieved context:\n" + context_str
 
         conversation_history.append({"role": "system", "content": combined_text})
 
-        response = model.create_chat_completion(
-            messages=conversation_history,
-        )
-
-        return response["choices"][0]["message"]["content"]
+        with self.use_answer_model(self.get_step_size("generate_response_with_context")) as model:
+            return self.create_answer(model, conversation_history, on_token)
 
     def finished_with_subdocs(self, messages, subject_list):
-        model = self.get_model()
+        model = self.get_step_model("finished_with_subdocs")
 
         system_prompt_finished = """Have the generated sub-documents covered all the subjects or concepts in the document? There may be subjects in this list that are redundant or 
         unneccesary. If the sub-documents created so far have covered all subjects listed in the following list, return True. Else, return False. If you believe the entirety of the 
@@ -342,10 +1005,32 @@ class LLMHandler:
 
         return response["choice"] == "yes"
 
-    def break_up_and_summarize_text(self, text):
-        model = self.get_model()
+    def get_subdoc_prompt(self, subject):
+        return f"""You are tasked with creating a sub-document for the subject: "{subject}". The sub-doc should mostly quote the original text,
+        but you may paraphrase if necessary to abridge or clarify. It should explain the named subject in its entirety. Make sure not to add any external information that isn't found in the original document. 
+        Include only the text relevant to the described subject, not text about other subjects. Those will be generated separately. The subdocument text word count is not to exceed {subdoc_word_limit}. 
+        There is no minimum length. If the subject is quickly described, that is not an issue. Just don't go beyond the limit. After the sub-document text, list the tags that describe the subject or concept found in the sub-document.
+        List only the tags that describe the contents of this sub-document. There may be one or two tags, or very many tags depending on the information conatined in the text
+        of the sub-document created. Tags will be used as meta-data for each sub document in a database such that if someone wanted the information in the document, it could be 
+        looked up by the tags, so design your tags for that use case. Tags are lowercase alphanumeric strings with underscores. Tags are single words or phrases. If there is a multi-word tag, 
+        use underscores "_" as spaces. Avoid tags that are not relevant to the subject but found elsewhere in the text, unless this subject is a subset of a larger subject also defined elsewhere."""
+
+    def parse_subdoc(self, subdoc_response):
+        tags_possible = subdoc_response["subdoc"]["tags"]
+        tags_trimmed = []
 
-        print("chunking text")
+        for tag in tags_possible:
+            if tag in tags_trimmed or tag == "":
+                continue
+            tags_trimmed.append(tag)
+
+        return {
+            "subdoc_text": subdoc_response["subdoc"]["subdoc_text"],
+            "tags": tags_trimmed,
+        }
+
+    def list_subjects(self, text, known_subjects=None):
+        model = self.get_model()
 
         system_prompt_subjects = """You are provided with a document. Your task is to identify the major one or more subjects or concepts present in the document.
         List each subject or concept found in the document as a JSON array. Do not explain them. The subjects should be concise and accurately describe topics found in the text.
@@ -357,6 +1042,14 @@ class LLMHandler:
         the document mentions serverless functions and then goes on to explain AWS Lambda, you would only list serverless functions as a subject, as that topic covers Lambda.
         You're not trying to reach a word count, think more in broad strokes, don't add every single detail or vocab word as a subject."""
 
+        # Windows of a long document list their subjects separately, known names keep the merged list free of duplicates
+        if known_subjects:
+            system_prompt_subjects += (
+                "\nThis text is part of a longer document. Subjects already found earlier in the document: "
+                + ", ".join(known_subjects)
+                + ". If this part continues one of them, use exactly the same name for it."
+            )
+
         messages = [
             {"role": "user", "content": text},
             {"role": "system", "content": system_prompt_subjects},
@@ -370,93 +1063,162 @@ class LLMHandler:
             verbose=True,
         )
 
-        subject_list = subject_response["subjects"]
+        return subject_response["subjects"]
+
+    def break_up_and_summarize_text(self, text, parallel=False, is_covered=None):
+        print("chunking text")
 
         subdocs = []
+        known_subjects = []
 
-        messages = [{"role": "user", "content": text}]
+        # Only one window and its own subdocs are ever in the context, however long the document is
+        for window in self.split_document(text):
+            subject_list = self.list_subjects(window, known_subjects)
 
-        for subject_item in subject_list:
-            subject = subject_item["subject"]
+            for subject_item in subject_list:
+                if subject_item["subject"].lower() not in [subject.lower() for subject in known_subjects]:
+                    known_subjects.append(subject_item["subject"])
 
-            print("making subdoc for subject: ", subject)
+            if parallel:
+                subdocs.extend(self.generate_subdocs_parallel(window, subject_list, is_covered))
+            else:
+                subdocs.extend(self.generate_subdocs_sequential(window, subject_list))
 
-            system_prompt_subdoc = f"""You are tasked with creating a sub-document for the subject: "{subject}". The sub-doc should mostly quote the original text,
-            but you may paraphrase if necessary to abridge or clarify. It should explain the named subject in its entirety. Make sure not to add any external information that isn't found in the original document. 
-            Include only the text relevant to the described subject, not text about other subjects. Those will be generated separately. The subdocument text word count is not to exceed {subdoc_word_limit}. 
-            There is no minimum length. If the subject is quickly described, that is not an issue. Just don't go beyond the limit. After the sub-document text, list the tags that describe the subject or concept found in the sub-document.
-            List only the tags that describe the contents of this sub-document. There may be one or two tags, or very many tags depending on the information conatined in the text
-            of the sub-document created. Tags will be used as meta-data for each sub document in a database such that if someone wanted the information in the document, it could be 
-            looked up by the tags, so design your tags for that use case. Tags are lowercase alphanumeric strings with underscores. Tags are single words or phrases. If there is a multi-word tag, 
-            use underscores "_" as spaces. Avoid tags that are not relevant to the subject but found elsewhere in the text, unless this subject is a subset of a larger subject also defined elsewhere."""
+        return subdocs
 
-            # Build the messages, including the history
-            messages.append({"role": "system", "content": system_prompt_subdoc})
+    def generate_subdocs_sequential(self, text, subject_list):
+        subdocs = []
 
-            # Generate sub-document for this subject
-            subdoc_response, assistant_content = PrintHandler.get_structured_output(
-                model,
-                messages,
-                subdoc_schema,
-                verbose=True,
-            )
+        # The finished check may load the small model between subjects
+        with self.use_model() as model:
+            messages = [{"role": "user", "content": text}]
 
-            tags_possible = subdoc_response["subdoc"]["tags"]
-            tags_trimmed = []
+            for subject_item in subject_list:
+                subject = subject_item["subject"]
 
-            for tag in tags_possible:
-                if tag in tags_trimmed or tag == "":
-                    continue
-                tags_trimmed.append(tag)
+                print("making subdoc for subject: ", subject)
 
-            subdocs.append(
-                {
-                    "subdoc_text": subdoc_response["subdoc"]["subdoc_text"],
-                    "tags": tags_trimmed,
-                }
-            )
+                # Build the messages, including the history
+                messages.append({"role": "system", "content": self.get_subdoc_prompt(subject)})
 
-            print(tags_trimmed)
+                # Generate sub-document for this subject
+                subdoc_response, assistant_content = PrintHandler.get_structured_output(
+                    model,
+                    messages,
+                    subdoc_schema,
+                    verbose=True,
+                )
 
-            # Add this response to the message history for context in the next loop
-            messages.append(
-                {
-                    "role": "assistant",
-                    "content": assistant_content,
-                }
-            )
+                subdoc = self.parse_subdoc(subdoc_response)
+                subdocs.append(subdoc)
 
-            if self.finished_with_subdocs(messages, subject_list):
-                print("LLM says all subjects already covered. Returning early.")
-                break
+                print(subdoc["tags"])
 
-        return subdocs
+                # Add this response to the message history for context in the next loop
+                messages.append(
+                    {
+                        "role": "assistant",
+                        "content": assistant_content,
+                    }
+                )
 
-    def generate_response(self, conversation_history):
-        model = self.get_model()
+                if self.finished_with_subdocs(messages, subject_list):
+                    print("LLM says all subjects already covered. Returning early.")
+                    break
 
-        # TODO: Figure out how to remove entries from conversation history such that we stay within a token limit
-        # tokens = model.tokenize(conversation_history)
-        # if len(tokens) > 28000:
-        #     truncated_tokens = tokens[-28000:]
-        #     conversation_history = self._model.detokenize(truncated_tokens).decode('utf-8')
+        return subdocs
 
+    def generate_subdocs_parallel(self, text, subject_list, is_covered=None):
+        models = self.get_subdoc_models()
+        idle_models = queue.Queue()
+        for model in models:
+            idle_models.put(model)
+
+        def generate(subject):
+            model = idle_models.get()
+            try:
+                # Every subject starts from the document prefix warmed below, so only the subject prompt is evaluated here
+                messages = [
+                    {"role": "user", "content": text},
+                    {"role": "system", "content": self.get_subdoc_prompt(subject)},
+                ]
+                # Streams from several instances would interleave on the terminal
+                subdoc_response, assistant_content = PrintHandler.get_structured_output(
+                    model, messages, subdoc_schema
+                )
+                return self.parse_subdoc(subdoc_response)
+            finally:
+                idle_models.put(model)
+
+        subjects = [subject_item["subject"] for subject_item in subject_list]
+        subdocs = {}
+        pending = {}
+        next_subject = 0
+
+        try:
+            # Started together, every instance would miss the shared prompt cache and evaluate the document itself.
+            # One instance evaluates it first, the rest load its state from the cache.
+            if len(subjects) > 1:
+                models[0].create_chat_completion(messages=[{"role": "user", "content": text}], max_tokens=1)
+
+            with ThreadPoolExecutor(max_workers=len(models)) as executor:
+                while next_subject < len(subjects) or pending:
+                    # Coverage is checked right before a subject is scheduled, against every subdoc finished so far
+                    while next_subject < len(subjects) and len(pending) < len(models):
+                        subject = subjects[next_subject]
+                        finished = [subdocs[i] for i in sorted(subdocs)]
+                        if is_covered is not None and finished and is_covered(subject, finished):
+                            print("subject already covered: ", subject)
+                        else:
+                            print("making subdoc for subject: ", subject)
+                            pending[executor.submit(generate, subject)] = next_subject
+                        next_subject += 1
+
+                    if not pending:
+                        continue
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        subdoc = future.result()
+                        subdocs[pending.pop(future)] = subdoc
+                        print(subdoc["tags"])
+        finally:
+            self.release_subdoc_models()
+
+        # Keep the subject order regardless of which subdoc finished first
+        return [subdocs[i] for i in sorted(subdocs)]
+
+    def generate_response(self, conversation_history, on_token=None):
         no_context_prompt = """Based on the conversation history, you have elected that the user query can be answered without additional context from your database. Respond to the user."""
 
+        with self.use_answer_model(self.get_step_size("generate_response")) as model:
+            return self.create_answer(
+                model, conversation_history + [{"role": "system", "content": no_context_prompt}], on_token
+            )
+
+    def summarize_conversation(self, previous_summary, messages, max_tokens=conversation_summary_tokens):
+        model = self.get_step_model("summarize_conversation")
+
+        system_prompt_summary = f"""Summarize the conversation below so it can replace it in the chat history. Keep the questions the user asked, the facts and 
+        answers given, and any information retrieved from the database that may be needed to answer follow-up questions. Leave out pleasantries and repetition. 
+        If a summary of the conversation before it is given, merge it into your summary. Do not exceed {max_tokens} tokens."""
+
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        if previous_summary:
+            transcript = "Summary of the conversation before this:\n" + previous_summary + "\n\nConversation:\n" + transcript
+
         response = model.create_chat_completion(
-            messages=conversation_history
-            + [{"role": "system", "content": no_context_prompt}]
+            messages=[
+                {"role": "system", "content": system_prompt_summary},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=max_tokens,
         )
 
         return response["choices"][0]["message"]["content"]
 
     def decide_to_respond_or_use_tool(self, conversation_history):
-        model = self.get_model()
-
-        # tokens = model.tokenize(conversation_history)
-        # if len(tokens) > 28000:
-        #     truncated_tokens = tokens[-28000:]
-        #     conversation_history = self._model.detokenize(truncated_tokens).decode('utf-8')
+        model = self.get_step_model("decide_to_respond_or_use_tool")
 
         system_prompt_choice = """Decide if the current conversation history has the specific factual answer to the question being posed in the most recent user 
         message. If it does contain the information, say yes. If not, say no. If you are unsure at all, say no.You are not to base this decision on existing general knowledge.
@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+MEMO_DIR = 'databases/memo'
+# memoized LLM decisions older than this are recomputed
+memo_ttl_seconds = 7 * 24 * 3600
+
+'''
+The memo handler module for agentic database. Persists the outputs of LLM steps that are deterministic for the same input
+(roadmaps, relevant tag selections) in <MEMO_DIR>/<kind>.db, so recurring queries don't pay an LLM call for them. Every entry
+is stored with a version, e.g. the model and the versions of the databases it was computed against, and is only returned while
+that version is current and the entry is younger than the TTL.
+
+The module provides the following functions:
+
+- get_memo_key(*parts): returns a stable key for JSON-serializable parts.
+    return: str
+- get(kind, key, version): returns the memoized value, or None if there is none, it is stale or expired.
+    return: JSON value | None
+- set(kind, key, version, value): memoizes the value.
+    return: None
+- get_stats(): returns hits and misses per kind since startup.
+    return: {str: {'hits': int, 'misses': int}}
+'''
+
+class MemoHandler:
+
+    def __init__(self, ttl=memo_ttl_seconds):
+        self.ttl = ttl
+        self.stats = {}
+
+    def get_memo_key(self, *parts):
+        return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def connect(self, kind):
+        if not os.path.exists(MEMO_DIR):
+            os.makedirs(MEMO_DIR)
+
+        conn = sqlite3.connect(os.path.join(MEMO_DIR, f"{kind}.db"))
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS memo (
+            key TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            value TEXT NOT NULL,
+            created REAL NOT NULL
+        )''')
+        conn.commit()
+
+        return conn
+
+    def get(self, kind, key, version):
+        stats = self.stats.setdefault(kind, {"hits": 0, "misses": 0})
+
+        conn = self.connect(kind)
+        cursor = conn.cursor()
+        cursor.execute('SELECT version, value, created FROM memo WHERE key = ?', (key,))
+        row = cursor.fetchone()
+        conn.close()
+
+        if row is None or row[0] != version or time.time() - row[2] > self.ttl:
+            stats["misses"] += 1
+            return None
+
+        stats["hits"] += 1
+        return json.loads(row[1])
+
+    def set(self, kind, key, version, value):
+        conn = self.connect(kind)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        INSERT OR REPLACE INTO memo (key, version, value, created) VALUES (?, ?, ?, ?)
+        ''', (key, version, json.dumps(value), time.time()))
+
+        # Expired entries would never be returned again
+        cursor.execute('DELETE FROM memo WHERE created < ?', (time.time() - self.ttl,))
+
+        conn.commit()
+        conn.close()
+
+    def get_stats(self):
+        return {kind: dict(stats) for kind, stats in self.stats.items()}
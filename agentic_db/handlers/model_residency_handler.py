@@ -0,0 +1,153 @@
+import os
+import gc
+import time
+import threading
+from collections import OrderedDict
+
+# fraction of physical RAM the resident models may take together
+ram_budget_fraction = 0.8
+# models unused for this long are released once the processor goes idle
+idle_timeout_seconds = 600
+
+'''
+The model residency handler module for agentic database. Owns the loaded LLM and embedding models so that they are kept in
+memory while a RAM budget allows, instead of being torn down and reloaded between steps. Models are registered with a loader,
+an unloader and a size estimate. When a load would exceed the budget, the least recently used models are evicted first.
+Models pinned by a running generation are never evicted to make room or for being idle, the budget may be exceeded instead.
+Releasing a model is only a hint, evict_idle unloads it once it has been idle longer than the idle timeout.
+The module provides the following functions:
+
+- register(name, loader, unloader, size_estimate): registers a model. loader returns the model, unloader frees it, size_estimate
+    returns the expected resident size in bytes.
+    return: None
+- get(name): returns the model, loading it (and evicting others if needed) when it isn't resident.
+    return: model object
+- pin(name): returns the model like get and keeps it resident until every pin on it is undone with unpin.
+    return: model object
+- unpin(name): undoes one pin of the model and marks it as used now.
+    return: None
+- release(name): marks the model as no longer in use.
+    return: None
+- evict(name): unloads the model immediately.
+    return: None
+- evict_idle(): unloads every unpinned model idle past the timeout.
+    return: [str]
+- get_stats(): returns load counts, total load time, residency and size estimate (as of the last load, 0 if never loaded) per model.
+    return: {str: {'loads': int, 'load_time': float, 'resident': bool, 'size_estimate': int}}
+'''
+
+def get_default_ram_budget():
+    # os.sysconf is not available on Windows, no budget means models are only evicted when idle
+    try:
+        physical_ram = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+    return int(physical_ram * ram_budget_fraction)
+
+
+class ModelResidencyHandler:
+
+    def __init__(self, ram_budget=None, idle_timeout=idle_timeout_seconds):
+        self.ram_budget = ram_budget if ram_budget is not None else get_default_ram_budget()
+        self.idle_timeout = idle_timeout
+        self.lock = threading.RLock()
+        self._models = {}
+        # resident models in least to most recently used order, name -> (model, size, last_used)
+        self._resident = OrderedDict()
+        # name -> number of pins, for models in use by a running generation
+        self._pins = {}
+        self.stats = {}
+
+    def register(self, name, loader, unloader, size_estimate):
+        with self.lock:
+            self._models[name] = (loader, unloader, size_estimate)
+            self.stats.setdefault(name, {"loads": 0, "load_time": 0.0, "size": 0})
+
+    def get(self, name):
+        with self.lock:
+            if name in self._resident:
+                model, size, _ = self._resident.pop(name)
+                self._resident[name] = (model, size, time.time())
+                return model
+
+            loader, unloader, size_estimate = self._models[name]
+            size = size_estimate()
+            self.make_room(size)
+
+            start = time.time()
+            model = loader()
+            load_time = time.time() - start
+
+            self.stats[name]["loads"] += 1
+            self.stats[name]["load_time"] += load_time
+            self.stats[name]["size"] = size
+            print(f"Loaded {name} model in {load_time:.2f}s (load #{self.stats[name]['loads']})")
+
+            self._resident[name] = (model, size, time.time())
+            return model
+
+    def pin(self, name):
+        with self.lock:
+            model = self.get(name)
+            self._pins[name] = self._pins.get(name, 0) + 1
+            return model
+
+    def unpin(self, name):
+        with self.lock:
+            if self._pins.get(name, 0) > 1:
+                self._pins[name] -= 1
+            else:
+                self._pins.pop(name, None)
+            self.release(name)
+
+    def make_room(self, size):
+        if self.ram_budget is None:
+            return
+
+        # Evict least recently used models until the new one fits the budget, pinned ones are still generating
+        while self.get_resident_size() + size > self.ram_budget:
+            unpinned = [name for name in self._resident if name not in self._pins]
+            if not unpinned:
+                break
+            self.evict(unpinned[0])
+
+    def get_resident_size(self):
+        return sum(size for _, size, _ in self._resident.values())
+
+    def release(self, name):
+        with self.lock:
+            if name in self._resident:
+                model, size, _ = self._resident[name]
+                self._resident[name] = (model, size, time.time())
+
+    def evict(self, name):
+        with self.lock:
+            if name not in self._resident:
+                return
+            del self._resident[name]
+            self._models[name][1]()
+            gc.collect()
+
+    def evict_idle(self):
+        with self.lock:
+            now = time.time()
+            idle = [
+                name for name, (_, _, last_used) in self._resident.items()
+                if self.idle_timeout is not None and now - last_used > self.idle_timeout and name not in self._pins
+            ]
+            for name in idle:
+                self.evict(name)
+            return idle
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                name: {
+                    "loads": self.stats[name]["loads"],
+                    "load_time": self.stats[name]["load_time"],
+                    "resident": name in self._resident,
+                    # sizing can mean downloading the model, so report the size seen at the last load
+                    "size_estimate": self.stats[name]["size"],
+                }
+                for name in self._models
+            }
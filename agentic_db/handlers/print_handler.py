@@ -32,6 +32,7 @@ class PrintHandler:
         messages: List[Dict[str, str]],
         response_schema: Dict[str, Any],
         verbose: bool = False,
+        sampling: Dict[str, Any] = None,
     ) -> Dict[str, Any]:
         """
         Streams the model output, printing the output progressively,
@@ -41,6 +42,7 @@ class PrintHandler:
             messages (List[Dict[str, str]]): The messages to send to the model.
             response_schema (Dict[str, Any]): The JSON schema defining the expected output.
             verbose (bool): If True, prints the streaming output.
+            sampling (Dict[str, Any]): Extra sampling settings passed to the model, e.g. temperature.
 
         Returns:
             Dict[str, Any]: The accumulated data as a dictionary after parsing the complete JSON.
@@ -50,6 +52,7 @@ class PrintHandler:
             messages=messages,
             response_format={"type": "json_object", "schema": response_schema},
             stream=True,
+            **(sampling or {}),
         )
 
         accumulated_text = ""
@@ -0,0 +1,139 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+PROMPT_CACHE_DIR = 'models/prompt_cache'
+# RAM kept for llama states (evaluated KV cache plus token ids) of recent prompts
+prompt_cache_ram_bytes = 1024 * 1024 * 1024
+# shorter shared prefixes (chat template headers) aren't worth copying a whole state back in for
+min_reused_tokens = 64
+
+'''
+The prompt cache handler module for agentic database. Keeps llama states of recently evaluated prompts so that a new prompt
+sharing a long prefix with one of them (a fixed system prompt, a document being split into sub-documents) only evaluates the
+part after the prefix. It implements the cache protocol of llama_cpp's LlamaRAMCache, so it is attached with Llama.set_cache
+and consulted by llama_cpp on every completion: the state with the longest matching token prefix is loaded, and the state
+after the completion is stored. Least recently used states are dropped beyond the RAM budget.
+
+States after prompts built on a static prompt can also be written to disk as snapshots, keyed by the model and the hash of the
+static prompt, and loaded into the cache in later processes so the static prefix is never evaluated from scratch again.
+
+The module provides the following functions:
+
+- get_snapshot_path(model_key, static_prompt): returns the snapshot file for the model and static prompt.
+    return: str
+- load_snapshot(model_key, static_prompt): loads the snapshot into the cache once per process, if it exists.
+    return: bool
+- save_snapshot(model_key, static_prompt, get_state): writes the state returned by get_state as the snapshot if there is none yet.
+    return: bool
+- clear(): drops every cached state, e.g. when the model changes.
+    return: None
+- get_stats(): returns the lookup hits and misses, prompt tokens served from the cache and snapshot loads and saves.
+    return: {'hits': int, 'misses': int, 'tokens_reused': int, 'snapshots_loaded': int, 'snapshots_saved': int, 'states': int, 'size': int}
+'''
+
+class PromptCacheHandler:
+
+    def __init__(self, capacity_bytes=prompt_cache_ram_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.lock = threading.RLock()
+        # token ids -> llama state, least to most recently used
+        self._states = OrderedDict()
+        self._loaded_snapshots = set()
+        self.stats = {"hits": 0, "misses": 0, "tokens_reused": 0, "snapshots_loaded": 0, "snapshots_saved": 0}
+
+    def find_longest_prefix_key(self, tokens):
+        best_key, best_length = None, 0
+
+        for key in self._states:
+            length = 0
+            for cached_token, token in zip(key, tokens):
+                if cached_token != token:
+                    break
+                length += 1
+            if length > best_length:
+                best_key, best_length = key, length
+
+        if best_length < min_reused_tokens:
+            return None, 0
+        return best_key, best_length
+
+    def __getitem__(self, tokens):
+        with self.lock:
+            key, length = self.find_longest_prefix_key(tuple(tokens))
+            if key is None:
+                self.stats["misses"] += 1
+                raise KeyError("No cached prompt shares a long enough prefix")
+
+            self.stats["hits"] += 1
+            self.stats["tokens_reused"] += length
+            self._states.move_to_end(key)
+            return self._states[key]
+
+    def __contains__(self, tokens):
+        with self.lock:
+            return self.find_longest_prefix_key(tuple(tokens))[0] is not None
+
+    def __setitem__(self, tokens, state):
+        with self.lock:
+            key = tuple(tokens)
+            self._states.pop(key, None)
+            self._states[key] = state
+
+            while len(self._states) > 1 and self.get_size() > self.capacity_bytes:
+                self._states.popitem(last=False)
+
+    def get_size(self):
+        return sum(state.llama_state_size for state in self._states.values())
+
+    def get_snapshot_path(self, model_key, static_prompt):
+        name = hashlib.sha1(f"{model_key}\n{static_prompt}".encode("utf-8")).hexdigest()
+        return os.path.join(PROMPT_CACHE_DIR, f"{name}.state")
+
+    def load_snapshot(self, model_key, static_prompt):
+        snapshot_path = self.get_snapshot_path(model_key, static_prompt)
+
+        with self.lock:
+            if snapshot_path in self._loaded_snapshots or not os.path.exists(snapshot_path):
+                return False
+
+            with open(snapshot_path, "rb") as f:
+                state = pickle.load(f)
+
+            self[state.input_ids.tolist()] = state
+            self._loaded_snapshots.add(snapshot_path)
+            self.stats["snapshots_loaded"] += 1
+            return True
+
+    def save_snapshot(self, model_key, static_prompt, get_state):
+        snapshot_path = self.get_snapshot_path(model_key, static_prompt)
+        if os.path.exists(snapshot_path):
+            return False
+
+        # Only copy the state out of the model when it is actually written
+        state = get_state()
+
+        if not os.path.exists(PROMPT_CACHE_DIR):
+            os.makedirs(PROMPT_CACHE_DIR)
+
+        # Written under a temp name first so a crash never leaves a truncated snapshot behind
+        tmp_path = snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f)
+        os.replace(tmp_path, snapshot_path)
+
+        with self.lock:
+            self._loaded_snapshots.add(snapshot_path)
+            self.stats["snapshots_saved"] += 1
+        return True
+
+    def clear(self):
+        with self.lock:
+            self._states.clear()
+            self._loaded_snapshots.clear()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, states=len(self._states), size=self.get_size())
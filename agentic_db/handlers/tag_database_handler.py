@@ -1,26 +1,59 @@
-from huggingface_hub import hf_hub_download
 import os
 import json
-from sentence_transformers import SentenceTransformer
-import faiss
-import numpy as np
+import sqlite3
 import gc
-import warnings
+import time
+import multiprocessing
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from agentic_db.handlers.doc_database_handler import DATABASE_DIR as DOC_DATABASE_DIR
+from agentic_db.handlers.doc_database_handler import get_tag_instances, get_all_tags, get_number_of_documents, get_tags_from_filter, get_last_modified
+from agentic_db.handlers.embedding_handler import create_embedding_backend
+from agentic_db.handlers.embedding_worker_handler import EmbeddingWorker
+from agentic_db.handlers.lazy_import import lazy_import
+
+faiss = lazy_import("faiss")
+np = lazy_import("numpy")
 
 MODELS_DIR = 'models/embedding'
 DATABASE_DIR = 'databases/tags'
 model_name = 'sentence-transformers/all-MiniLM-L6-v2'
 model_path = os.path.join(MODELS_DIR, model_name)
 embedding_dim = 384
+# resident size of the embedding model for the residency budget
+embedding_model_size_estimate = 256 * 1024 * 1024
+
+# serving layout: IVF index whose inverted lists live in a separate mmap-able data file
+serving_min_vectors = 1000
+serving_nprobe = 16
+
+# journaled tag adds/removes are folded into the base index once this many are pending
+journal_checkpoint_ops = 1000
+
+# reranking weights for cosine similarity, tag IDF over sub-documents and past selection rate
+rerank_weights = {"similarity": 1.0, "idf": 0.3, "history": 0.2}
+
+# ID selectors kept per (title, tag filter), oldest dropped first
+filter_cache_size = 64
+
+# dimensionality reduction: PCA output dims, fewest vectors to train on, and query sample size for recall evaluation
+reduced_dim = 192
+reduction_min_vectors = 1000
+evaluation_sample_size = 200
+
+# neighbors stored per tag in the precomputed neighbor graph, and how many rows are searched or fetched at once
+neighbor_graph_k = 20
+neighbor_graph_batch = 500
 
 '''
 The vector tag database handler module for agentic database. Provides insertion and nearest neighbor search operations
-for the tag database. Vector indices are paired with matching named json dictionaries to map index to string. Intended to match near-tags from LLM analysis with real-tags present in the document SQL database.
+for the tag database. Vector indices are paired with a matching named SQLite id store (<title>-tags.db) that maps index id to tag
+string and keeps the free-list of ids released by deletions. Intended to match near-tags from LLM analysis with real-tags present in the document SQL database.
 The module provides the following functions:
 
-- def get_model(model_name): loads the SentenceTransformer model or retrieves it if it already exists.
-    return: SentenceTransformer object
-- def release_model(model): releases SentenceTransformer model from memory.
+- def get_model(model_name): loads the embedding model through the configured backend or retrieves it if it already exists.
+    return: embedding backend object (see embedding_handler)
+- def release_model(model): releases the embedding model from memory, or hands it back to the residency handler if one is used.
     return: None
 - def create_database(title): creates a new database with the given title and returns True if the database was created, False if it already exists.
     return: bool
@@ -28,36 +61,171 @@ The module provides the following functions:
     return: bool
 - def add_entry_to_database(title, embedding, tag): adds an entry to the database with the given title.
     return: bool
-- def get_nearest_neighbors(title, embedding, tag, k=20): returns the k nearest neighbors to the given tag(s) in the database with the given title.
+- def get_nearest_neighbors(title, embedding, tag, k=20, tag_filter=None): returns the k nearest neighbors to the given tag(s) in the database with the given title.
     return: [[str]]
+- def get_filter_selector(title, tag_filter): returns a FAISS ID selector over the ids of tags carried by documents matching the
+    tag filter (see doc_database_handler), and how many ids it holds. Cached per filter until the document database or id store changes.
+    return: (faiss.IDSelectorBatch, int)
+- def reduce_dimensions(title, dim=reduced_dim): rebuilds the index with a PCA projection to dim dimensions trained on the database's
+    tag vectors. The projection, followed by an L2 normalization, is stored in the index file (a FAISS IndexPreTransform) and applied
+    to both stored and query vectors. Scores are then cosines of the centered, projected vectors, which approximate the full-dimension
+    cosines: centering shifts them and the dropped components are lost, so thresholds tuned on full dimensions may need adjusting.
+    Pass dim=None to go back to full dimensions. Tags are re-embedded when the current index is already reduced.
+    return: bool
+- def evaluate_reduction(title, dim=reduced_dim, k=10): compares a dim-dimensional projection against the full-dimension index on a
+    sample of the database's tags, reporting recall@k of the exact neighbors, per-query search time and vector memory for both.
+    Recall measures how well the approximate projected cosines preserve the neighbor order, not how close the scores are.
+    return: {'dim': int, 'recall': float, 'full_search_ms': float, 'reduced_search_ms': float, 'full_bytes': int, 'reduced_bytes': int} | None
+- def build_neighbor_graph(title): computes the neighbor_graph_k nearest neighbors of every tag in the database and stores them
+    in the id store as compact id/distance arrays keyed by tag id. Once built, the graph is kept up to date as tags are added and removed.
+    return: bool
+- def get_tag_neighbors(title, tags): looks up the stored neighbors of the given real tags, without embedding or searching.
+    return: {str: [(str, float)]} - tag to (neighbor tag, squared L2 distance), nearest first
+- def prefetch_tags(tags): starts embedding the tags in the background when the embedding worker is used, so the next
+    search with the same tags doesn't wait on the model.
+    return: None
+- def search_tags(title, tags, k=20, max_distance=None, min_similarity=None, metric="l2", tag_filter=None): batched, scored nearest neighbor search.
+    All query tags are embedded and searched in one call, neighbors are deduplicated across the query tags (keeping the best score),
+    cut by max_distance (squared L2) and/or min_similarity (cosine), and paired with their instance counts from the document database.
+    With metric="cosine" the score is the cosine similarity of the normalized vectors, highest first, otherwise the L2 distance, lowest first.
+    With a tag_filter only tags of documents in scope are searched, through an ID selector inside FAISS rather than post-filtering.
+    Query tags that are real tags with a neighbor graph row are answered from the graph, without embedding or searching.
+    return: [(str, float, int)]
+- def search_tags_federated(titles, tags, k=20, max_distance=None, min_similarity=None, metric="l2", tag_filter=None): search_tags fanned out over several
+    databases in parallel. The query tags are embedded once and the per-database results merged by score.
+    return: [(str, str, float, int)] - (title, tag, score, instances)
+- def rerank_tags(results, weights=None, limit=None, metric="cosine"): reranks search_tags_federated results of the given metric by a weighted
+    sum of similarity (L2 distances are converted to it), an IDF-like score from the tag's instance count, and how often the tag was selected
+    when it was offered to the LLM.
+    return: [(str, str, float, int)] - (title, tag, combined score, instances), best first, cut to limit
+- def record_tag_selection(title, candidates, selected): records which candidate tags the relevance step selected, for reranking.
+    Nothing is recorded in read-only mode.
+    return: None
 - def delete_entry_from_database(title, tags): deletes the given tags from the database with the given title. Will remove the tag from 
-    the index and the json tag map.
+    the index and the id store, and put its id on the free-list for reuse.
     return: None
+- def get_ids_from_tags(title, tags): returns a {tag: id} dict for the given tags that exist in the id store.
+    return: {str: int}
+- def get_tags_from_ids(title, ids): returns a {id: tag} dict for the given ids that exist in the id store.
+    return: {int: str}
+
+- def load_index(title): returns the index for searching. Cached per process and reloaded only when the file changes. In read-only mode
+    indexes are opened with FAISS mmap flags, preferring the serving layout if it is up to date, and journaled changes not checkpointed
+    yet are searched from a small in-memory overlay (JournalOverlayIndex) instead of being replayed into a private copy.
+    return: faiss.Index | JournalOverlayIndex | None
+- def checkpoint(title): folds the pending journal into the base index, written to a temp file and renamed into place.
+    return: bool
+- def build_serving_index(title): writes the serving layout (<title>-serving.index + <title>-serving.ivfdata), an IVF index with
+    on-disk inverted lists, so query processes on one host share the page cache instead of each holding a private copy.
+    return: bool
+- def reconcile(title, tags=None): brings the index and id store in line with the tag table of the document database. Removes tags
+    that no longer exist in SQL (e.g. dropped to zero instances) and vectors with no id mapping, and adds SQL tags missing from the
+    index in one batch. Pass tags to only check those (incremental, after a delete), or leave None for a full pass.
+    return: {'orphan_vectors_removed': int, 'tags_removed': [str], 'tags_added': [str]} | None
+
+Ids are allocated from the free-list first, then from a monotonic counter, so ids never collide after deletions.
+
+Adds and deletes never rewrite the base index. Each batch is appended to the journal table of the id store (with the vectors of
+added tags) in the same transaction as the id changes, so a batch is durable once SQLite commits it and the id map and journal
+can't disagree. The journal is replayed onto the base index on load, and checkpointed into it every journal_checkpoint_ops operations.
+Replay applies the last operation per id as one removal and one batch add, so replaying after an interrupted checkpoint is harmless.
+Neighbor graph rows keep the distance of their last neighbor as a radius. A new tag can only enter the rows whose radius it falls
+within, found with a range search on its vector, and rows that listed a removed tag (found through the tag_neighbor_edges reverse
+edges) are recomputed by searching their own vector.
+Databases created before the id store existed (<title>-tags.json and <title>-deleted-ids.json) are migrated on first access.
+The schema is set up and migrated once per process, on the first writable connection. Read-only replicas open the id store in
+SQLite's read-only mode and never write to it, so a database has to be created (or opened once by a writer to migrate it) first.
 '''
+class JournalOverlayIndex:
+
+    # Searched like a FAISS index: the mmapped base, minus the ids the journal touched, merged with the journaled adds
+    def __init__(self, base, overlay, touched_ids):
+        self.base = base
+        self.overlay = overlay
+        self.touched_ids = set(touched_ids)
+        self.d = base.d
+        # an upper bound, touched ids still counted in the base only make the search pad with -1
+        self.ntotal = base.ntotal + overlay.ntotal
+
+    def search(self, x, k, params=None):
+        # Base hits on touched ids are stale, so search deep enough to still have k neighbors without them
+        base_k = min(k + len(self.touched_ids), self.base.ntotal)
+        overlay_k = min(k, self.overlay.ntotal)
+
+        rows = [[] for _ in range(len(x))]
+        if base_k > 0:
+            D, I = self.base.search(x, base_k, params=params)
+            for row, distances, ids in zip(rows, D, I):
+                row.extend((float(d), int(i)) for d, i in zip(distances, ids) if i != -1 and int(i) not in self.touched_ids)
+        if overlay_k > 0:
+            # The overlay is a flat index, it only takes the id selector of IVF search parameters
+            overlay_params = faiss.SearchParameters(sel=params.sel) if params is not None and params.sel is not None else None
+            D, I = self.overlay.search(x, overlay_k, params=overlay_params)
+            for row, distances, ids in zip(rows, D, I):
+                row.extend((float(d), int(i)) for d, i in zip(distances, ids) if i != -1)
+
+        D = np.full((len(x), k), np.inf, dtype=np.float32)
+        I = np.full((len(x), k), -1, dtype=np.int64)
+        for n, row in enumerate(rows):
+            row.sort()
+            for j, (distance, i) in enumerate(row[:k]):
+                D[n, j], I[n, j] = distance, i
+        return D, I
+
+
 class TagDatabaseHandler:
 
     #singleton model
     _model = None
 
-    def __init__(self):
-        print("Downloading or loading the embedding model locally...")
-        self.get_model()
+    def __init__(self, read_only=False, residency=None, embedding_backend=None, embedding_worker=False):
+        self.read_only = read_only
+        # None uses the backend configured in embedding_handler
+        self.embedding_backend = embedding_backend
+        # run the embedding model in its own process so it can work while the LLM generates
+        self.embedding_worker = embedding_worker
+        self._pending_embeddings = {}
+        self._index_cache = {}
+        self._filter_cache = {}
+        # stores whose schema and legacy migration were already set up by this process
+        self._ready_stores = set()
+        # when a residency handler is given it decides when the model is loaded and evicted
+        self.residency = residency
+        if self.residency is not None:
+            self.residency.register(
+                "embedding", self.load_model, self.unload_model, lambda: embedding_model_size_estimate
+            )
 
     def get_model(self):
+        if self.residency is not None:
+            return self.residency.get("embedding")
+        return self.load_model()
+
+    def load_model(self):
         if self._model is None:
+            print("Downloading or loading the embedding model locally...")
             # Ensure the directory exists
             if not os.path.exists(MODELS_DIR):
                 os.makedirs(MODELS_DIR)
-            # Load the model and cache it locally in MODELS_DIR
-            warnings.filterwarnings("ignore", category=FutureWarning, message=".*clean_up_tokenization_spaces.*")
-
-            self._model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2', cache_folder=MODELS_DIR)
-
-            self._model.tokenizer.clean_up_tokenization_spaces = True
+            # Load the model through the configured backend and cache it locally in MODELS_DIR.
+            # A worker started from inside another worker process would recurse, so those load in-process.
+            if self.embedding_worker and multiprocessing.parent_process() is None:
+                self._model = EmbeddingWorker(self.embedding_backend)
+            else:
+                self._model = create_embedding_backend(self.embedding_backend)
         return self._model
 
     def release_model(self):
+        if self.residency is not None:
+            self.residency.release("embedding")
+            return
+        self.unload_model()
+
+    def unload_model(self):
         if self._model is not None:
+            if isinstance(self._model, EmbeddingWorker):
+                self._model.stop()
+            self._pending_embeddings = {}
             del self._model
             self._model = None
             gc.collect()
@@ -68,89 +236,854 @@ class TagDatabaseHandler:
 
     def create_database(self, title):
         db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
-        json_path = os.path.join(DATABASE_DIR, f"{title}-tags.json")
         
         if not os.path.exists(db_path):
             self.create_database_dir()
 
-            # Use IndexIDMap to allow custom ID handling
-            index = faiss.IndexIDMap(faiss.IndexFlatL2(embedding_dim))
-            faiss.write_index(index, db_path)
-            
-            with open(json_path, 'w') as f:
-                json.dump({}, f)
+            # IndexIDMap2 allows custom ids and reconstructing a vector by its id
+            index = faiss.IndexIDMap2(faiss.IndexFlatL2(embedding_dim))
+            self.write_index_atomic(index, db_path)
+
+            conn = self.connect_tag_store(title)
+            conn.close()
             
             return True
         return False
 
     def delete_database(self, title):
         db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        store_path = os.path.join(DATABASE_DIR, f"{title}-tags.db")
         json_path = os.path.join(DATABASE_DIR, f"{title}-tags.json")
         deleted_ids_json_path = os.path.join(DATABASE_DIR, f"{title}-deleted-ids.json")
+        serving_path = os.path.join(DATABASE_DIR, f"{title}-serving.index")
+        serving_data_path = os.path.join(DATABASE_DIR, f"{title}-serving.ivfdata")
         
         if os.path.exists(db_path):
             os.remove(db_path)
-            os.remove(json_path)
-            if os.path.exists(deleted_ids_json_path):
-                os.remove(deleted_ids_json_path)
+            self._index_cache.pop(title, None)
+            self._ready_stores.discard(title)
+            for key in [key for key in self._filter_cache if key[0] == title]:
+                del self._filter_cache[key]
+            for path in [store_path, json_path, deleted_ids_json_path, serving_path, serving_data_path, db_path + ".tmp"]:
+                if os.path.exists(path):
+                    os.remove(path)
             return True
         return False
 
-    def load_index_to_tag_map(self, title):
-        json_path = os.path.join(DATABASE_DIR, f"{title}-tags.json")
-        if os.path.exists(json_path):
-            with open(json_path, 'r') as f:
-                return json.load(f)
-        return {}
+    def connect_tag_store(self, title):
+        store_path = os.path.join(DATABASE_DIR, f"{title}-tags.db")
+
+        # Read-only replicas never write to the store, its schema is set up by the writing process
+        if self.read_only:
+            return sqlite3.connect(f"file:{urllib.request.pathname2url(os.path.abspath(store_path))}?mode=ro", uri=True)
+
+        if title in self._ready_stores and os.path.exists(store_path):
+            return sqlite3.connect(store_path)
+
+        self.create_database_dir()
+        conn = sqlite3.connect(store_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_ids (
+            id INTEGER PRIMARY KEY,
+            tag TEXT UNIQUE NOT NULL
+        )''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS free_ids (
+            id INTEGER PRIMARY KEY
+        )''')
 
-    def save_index_to_tag_map(self, title, index_to_tag):
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS allocator (
+            next_id INTEGER NOT NULL
+        )''')
+
+        cursor.execute('SELECT COUNT(*) FROM allocator')
+        if cursor.fetchone()[0] == 0:
+            cursor.execute('INSERT INTO allocator (next_id) VALUES (0)')
+
+        legacy_paths = self.migrate_legacy_tag_map(title, cursor)
+
+        # Stores created before these tables existed get them on first access
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            vector BLOB
+        )''')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_neighbors (
+            id INTEGER PRIMARY KEY,
+            neighbor_ids BLOB NOT NULL,
+            distances BLOB NOT NULL,
+            radius REAL NOT NULL
+        )''')
+
+        # Reverse edges of the neighbor graph, so the rows listing a removed tag are found without scanning every row
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_neighbor_edges (
+            neighbor_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            PRIMARY KEY (neighbor_id, id)
+        ) WITHOUT ROWID''')
+
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM tag_neighbor_edges), EXISTS (SELECT 1 FROM tag_neighbors)')
+        has_edges, has_graph = cursor.fetchone()
+        if has_graph and not has_edges:
+            cursor.execute('SELECT id, neighbor_ids FROM tag_neighbors')
+            self.write_neighbor_edges(cursor, cursor.fetchall())
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tag_selections (
+            tag TEXT PRIMARY KEY,
+            candidate_count INTEGER NOT NULL DEFAULT 0,
+            selected_count INTEGER NOT NULL DEFAULT 0
+        )''')
+        conn.commit()
+
+        # The json map is only dropped once the store holding its contents is committed
+        for path in legacy_paths:
+            os.remove(path)
+
+        self._ready_stores.add(title)
+        return conn
+
+    def migrate_legacy_tag_map(self, title, cursor):
         json_path = os.path.join(DATABASE_DIR, f"{title}-tags.json")
-        with open(json_path, 'w') as f:
-            json.dump(index_to_tag, f)
+        deleted_ids_json_path = os.path.join(DATABASE_DIR, f"{title}-deleted-ids.json")
 
-    def add_entry_to_database(self, title, tag):
+        if not os.path.exists(json_path):
+            return []
+
+        # A store that already holds tags got the json map committed, only the file removal didn't happen
+        cursor.execute('SELECT COUNT(*) FROM tag_ids')
+        if cursor.fetchone()[0] == 0:
+            self.insert_legacy_tag_map(json_path, deleted_ids_json_path, cursor)
+
+        return [path for path in [json_path, deleted_ids_json_path] if os.path.exists(path)]
+
+    def insert_legacy_tag_map(self, json_path, deleted_ids_json_path, cursor):
+        with open(json_path, 'r') as f:
+            index_to_tag = json.load(f)
+
+        deleted_ids = []
+        if os.path.exists(deleted_ids_json_path):
+            with open(deleted_ids_json_path, 'r') as f:
+                deleted_ids = json.load(f)
+
+        # json keys come back as strings, ids may have been stored as either
+        cursor.executemany('''
+        INSERT OR IGNORE INTO tag_ids (id, tag) VALUES (?, ?)
+        ''', [(int(i), t) for i, t in index_to_tag.items()])
+
+        used_ids = set(int(i) for i in index_to_tag)
+        cursor.executemany('''
+        INSERT OR IGNORE INTO free_ids (id) VALUES (?)
+        ''', [(int(i),) for i in deleted_ids if int(i) not in used_ids])
+
+        all_ids = used_ids | set(int(i) for i in deleted_ids)
+        next_id = max(all_ids) + 1 if all_ids else 0
+        cursor.execute('UPDATE allocator SET next_id = ?', (next_id,))
+
+    def allocate_ids(self, cursor, count):
+        if count <= 0:
+            return []
+
+        # Reuse freed ids first, then take fresh ones from the monotonic counter
+        cursor.execute('SELECT id FROM free_ids ORDER BY id LIMIT ?', (count,))
+        ids = [row[0] for row in cursor.fetchall()]
+
+        if ids:
+            cursor.executemany('DELETE FROM free_ids WHERE id = ?', [(i,) for i in ids])
+
+        remaining = count - len(ids)
+        if remaining > 0:
+            cursor.execute('SELECT next_id FROM allocator')
+            next_id = cursor.fetchone()[0]
+            ids.extend(range(next_id, next_id + remaining))
+            cursor.execute('UPDATE allocator SET next_id = ?', (next_id + remaining,))
+
+        return ids
+
+    def get_ids_from_tags(self, title, tags):
+        if isinstance(tags, str):
+            tags = [tags]
+        if not tags:
+            return {}
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+
+        placeholder = ', '.join(['?'] * len(tags))
+        cursor.execute(f'SELECT tag, id FROM tag_ids WHERE tag IN ({placeholder})', tuple(tags))
+        tag_to_id = dict(cursor.fetchall())
+
+        conn.close()
+        return tag_to_id
+
+    def get_tags_from_ids(self, title, ids):
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+
+        placeholder = ', '.join(['?'] * len(ids))
+        cursor.execute(f'SELECT id, tag FROM tag_ids WHERE id IN ({placeholder})', tuple(ids))
+        id_to_tag = dict(cursor.fetchall())
+
+        conn.close()
+        return id_to_tag
+
+    def load_index(self, title):
         db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
-        if os.path.exists(db_path):
-            model = self.get_model()
+        if not os.path.exists(db_path):
+            return None
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+        journal_seq = self.get_journal_seq(cursor)
+
+        path = db_path
+        io_flags = 0
+
+        # An mmapped index can't take journal replays, pending changes are searched from an overlay next to it
+        if self.read_only:
+            serving_path = os.path.join(DATABASE_DIR, f"{title}-serving.index")
+            # A serving layout older than the base index is stale, fall back to the base index
+            if os.path.exists(serving_path) and os.path.getmtime(serving_path) >= os.path.getmtime(db_path):
+                path = serving_path
+                # On-disk inverted lists map their .ivfdata file themselves, IO_FLAG_MMAP would skip loading them
+                io_flags = faiss.IO_FLAG_READ_ONLY
+            else:
+                # IO_FLAG_MMAP_IFC maps flat codes on newer FAISS builds, older ones only map inverted lists
+                io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._index_cache.get(title)
+        if cached is not None and cached[0] == path and cached[1] == mtime:
+            cached_path, cached_mtime, index, applied_seq, writable = cached
+            if applied_seq == journal_seq:
+                conn.close()
+                return index
+            # Only replay what was journaled since the last load
+            if writable and applied_seq < journal_seq:
+                applied_seq = self.apply_journal(index, cursor, applied_seq)
+                self._index_cache[title] = (path, mtime, index, applied_seq, writable)
+                conn.close()
+                return index
+            # The mapped base is kept, only the overlay is rebuilt from the journal
+            if not writable:
+                base = index.base if isinstance(index, JournalOverlayIndex) else index
+                index, applied_seq = self.create_journal_overlay(base, cursor)
+                self._index_cache[title] = (path, mtime, index, applied_seq, writable)
+                conn.close()
+                return index
+
+        index = faiss.read_index(path, io_flags)
+        if path != db_path:
+            faiss.extract_index_ivf(index).nprobe = serving_nprobe
+
+        if journal_seq == 0:
+            applied_seq = 0
+        elif io_flags == 0:
+            applied_seq = self.apply_journal(index, cursor)
+        else:
+            index, applied_seq = self.create_journal_overlay(index, cursor)
+        conn.close()
+
+        self._index_cache[title] = (path, mtime, index, applied_seq, io_flags == 0)
+        return index
+
+    def write_index_atomic(self, index, path):
+        tmp_path = path + ".tmp"
+        faiss.write_index(index, tmp_path)
+        with open(tmp_path, 'r+b') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def get_journal_seq(self, cursor):
+        cursor.execute('SELECT MAX(seq) FROM journal')
+        journal_seq = cursor.fetchone()[0]
+        return journal_seq or 0
+
+    def get_store_version(self, cursor):
+        # The AUTOINCREMENT counter keeps growing after checkpoints delete journal rows, unlike MAX(seq)
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'journal'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def append_journal(self, cursor, op, ids, vectors=None):
+        if vectors is None:
+            cursor.executemany('''
+            INSERT INTO journal (op, id) VALUES (?, ?)
+            ''', [(op, int(i)) for i in ids])
+        else:
+            cursor.executemany('''
+            INSERT INTO journal (op, id, vector) VALUES (?, ?, ?)
+            ''', [(op, int(i), vector.astype('float32').tobytes()) for i, vector in zip(ids, vectors)])
+
+    def read_journal(self, cursor, after_seq=0):
+        cursor.execute('SELECT seq, op, id, vector FROM journal WHERE seq > ? ORDER BY seq', (after_seq,))
+
+        last_seq = after_seq
+        last_ops = {}
+        for seq, op, i, vector in cursor.fetchall():
+            last_ops[i] = (op, vector)
+            last_seq = seq
+
+        return last_seq, last_ops
+
+    def create_journal_overlay(self, base, cursor):
+        last_seq, last_ops = self.read_journal(cursor)
+
+        # Journaled vectors are unprojected, the overlay applies the same transforms as the base
+        if isinstance(base, faiss.IndexPreTransform):
+            overlay = faiss.IndexPreTransform(faiss.IndexIDMap(faiss.IndexFlatL2(base.index.d)))
+            for i in reversed(range(base.chain.size())):
+                overlay.prepend_transform(base.chain.at(i))
+        else:
+            overlay = faiss.IndexIDMap(faiss.IndexFlatL2(base.d))
+
+        added = [(i, vector) for i, (op, vector) in last_ops.items() if op == "add"]
+        if added:
+            ids = np.array([i for i, _ in added], dtype=np.int64)
+            vectors = np.array([np.frombuffer(vector, dtype=np.float32) for _, vector in added])
+            overlay.add_with_ids(vectors, ids)
+
+        return JournalOverlayIndex(base, overlay, last_ops), last_seq
+
+    def apply_journal(self, index, cursor, after_seq=0):
+        last_seq, last_ops = self.read_journal(cursor, after_seq)
+
+        if last_ops:
+            # Net effect per id: one removal of every touched id, then one batch add of those whose last op is an add
+            index.remove_ids(faiss.IDSelectorBatch(np.array(list(last_ops), dtype=np.int64)))
+
+            added = [(i, vector) for i, (op, vector) in last_ops.items() if op == "add"]
+            if added:
+                ids = np.array([i for i, _ in added], dtype=np.int64)
+                vectors = np.array([np.frombuffer(vector, dtype=np.float32) for _, vector in added])
+                index.add_with_ids(vectors, ids)
+
+        return last_seq
+
+    def checkpoint(self, title):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        if not os.path.exists(db_path):
+            return False
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+
+        journal_seq = self.get_journal_seq(cursor)
+        if journal_seq == 0:
+            conn.close()
+            return False
+
+        index = faiss.read_index(db_path)
+        self.apply_journal(index, cursor)
+        self.write_index_atomic(index, db_path)
+
+        # A crash before this commit leaves the journal in place, replaying it onto the new base is a no-op
+        cursor.execute('DELETE FROM journal WHERE seq <= ?', (journal_seq,))
+        conn.commit()
+        conn.close()
+
+        self._index_cache.pop(title, None)
+        return True
+
+    def checkpoint_if_needed(self, title):
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM journal')
+        pending = cursor.fetchone()[0]
+        conn.close()
+
+        if pending >= journal_checkpoint_ops:
+            self.checkpoint(title)
+
+    def build_serving_index(self, title):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        serving_path = os.path.join(DATABASE_DIR, f"{title}-serving.index")
+        serving_data_path = os.path.join(DATABASE_DIR, f"{title}-serving.ivfdata")
+
+        if not os.path.exists(db_path):
+            return False
+
+        # The serving layout is built from the base index alone, so fold the journal in first
+        self.checkpoint(title)
+
+        index = faiss.read_index(db_path)
+        num_vectors = index.ntotal
+
+        for path in [serving_path, serving_data_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        if num_vectors < serving_min_vectors:
+            print("Index is small enough to be served from the base index.")
+            return False
+
+        # Vectors of a reduced index are already projected, the IVF index is built in the reduced space
+        id_map_index = self.get_id_map_index(index)
+        vectors = id_map_index.index.reconstruct_n(0, num_vectors)
+        ids = faiss.vector_to_array(id_map_index.id_map).astype(np.int64)
+
+        # roughly 4 * sqrt(n) lists, keeping enough training points per list
+        nlist = max(1, min(int(4 * np.sqrt(num_vectors)), num_vectors // 39))
+        quantizer = faiss.IndexFlatL2(id_map_index.d)
+        serving_index = faiss.IndexIVFFlat(quantizer, id_map_index.d, nlist)
+        serving_index.train(vectors)
+
+        # Store the inverted lists in their own file so they can be mmapped on load
+        invlists = faiss.OnDiskInvertedLists(nlist, serving_index.code_size, serving_data_path)
+        serving_index.replace_invlists(invlists, True)
+        invlists.this.disown()
+
+        serving_index.add_with_ids(vectors, ids)
+        if id_map_index is not index:
+            # The same transforms (projection and normalization) in the same order as the base index
+            serving_index = faiss.IndexPreTransform(serving_index)
+            for i in reversed(range(index.chain.size())):
+                serving_index.prepend_transform(index.chain.at(i))
+        faiss.write_index(serving_index, serving_path)
+
+        self._index_cache.pop(title, None)
+        return True
+
+    def build_neighbor_graph(self, title):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        if not os.path.exists(db_path):
+            return False
+
+        # Built from the base index alone, so fold the journal in first
+        self.checkpoint(title)
+
+        index = faiss.read_index(db_path)
+        num_vectors = index.ntotal
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM tag_neighbors')
+        cursor.execute('DELETE FROM tag_neighbor_edges')
+
+        if num_vectors > 0:
+            # Stored vectors of a reduced index are already projected, so search them past the projection
+            id_map_index = self.get_id_map_index(index)
+            vectors = id_map_index.index.reconstruct_n(0, num_vectors)
+            ids = faiss.vector_to_array(id_map_index.id_map).astype(np.int64)
+
+            # the first hit of every row is normally the tag itself, search one further
+            k = min(neighbor_graph_k + 1, num_vectors)
+            for start in range(0, num_vectors, neighbor_graph_batch):
+                D, I = id_map_index.search(vectors[start:start + neighbor_graph_batch], k)
+                self.write_neighbor_rows(cursor, ids[start:start + neighbor_graph_batch], D, I)
+
+        conn.commit()
+        conn.close()
+        return True
+
+    def make_neighbor_row(self, tag_id, distances, ids):
+        keep = (ids != -1) & (ids != tag_id)
+        neighbor_ids = ids[keep][:neighbor_graph_k].astype(np.int64)
+        neighbor_distances = distances[keep][:neighbor_graph_k].astype(np.float32)
+
+        # A full row can only be entered by tags closer than its last neighbor, a short one by any tag
+        radius = float(neighbor_distances[-1]) if len(neighbor_ids) == neighbor_graph_k else float("inf")
+        return (int(tag_id), neighbor_ids.tobytes(), neighbor_distances.tobytes(), radius)
+
+    def write_neighbor_rows(self, cursor, tag_ids, D, I):
+        self.store_neighbor_rows(
+            cursor, [self.make_neighbor_row(int(i), row_distances, row_ids) for i, row_distances, row_ids in zip(tag_ids, D, I)]
+        )
+
+    def store_neighbor_rows(self, cursor, rows):
+        cursor.executemany('''
+        INSERT OR REPLACE INTO tag_neighbors (id, neighbor_ids, distances, radius) VALUES (?, ?, ?, ?)
+        ''', rows)
+
+        # A replaced row drops the edges of its old neighbors
+        cursor.executemany('DELETE FROM tag_neighbor_edges WHERE id = ?', [(row[0],) for row in rows])
+        self.write_neighbor_edges(cursor, [(row[0], row[1]) for row in rows])
+
+    def write_neighbor_edges(self, cursor, rows):
+        cursor.executemany('''
+        INSERT OR IGNORE INTO tag_neighbor_edges (neighbor_id, id) VALUES (?, ?)
+        ''', [(int(n), int(i)) for i, neighbor_ids in rows for n in np.frombuffer(neighbor_ids, dtype=np.int64)])
+
+    def get_vectors_from_ids(self, index, ids):
+        id_map_index = self.get_id_map_index(index)
+        # IndexIDMap2 looks ids up in its reverse map, indexes written before it was used only have the forward map
+        if isinstance(id_map_index, faiss.IndexIDMap2):
+            return np.array([id_map_index.reconstruct(int(i)) for i in ids], dtype=np.float32)
+
+        id_map = faiss.vector_to_array(id_map_index.id_map)
+        positions = {int(id_map[position]): int(position) for position in np.flatnonzero(np.isin(id_map, np.asarray(ids, dtype=np.int64)))}
+        return np.array([id_map_index.index.reconstruct(positions[int(i)]) for i in ids], dtype=np.float32)
+
+    def update_neighbor_graph(self, title, added_ids=None, added_vectors=None, removed_ids=None):
+        index = self.load_index(title)
+        if index is None:
+            return
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT COUNT(*) FROM tag_neighbors')
+        if cursor.fetchone()[0] == 0:
+            # No graph built for this database yet
+            conn.close()
+            return
+
+        num_vectors = index.ntotal
+        k = min(neighbor_graph_k + 1, num_vectors)
+
+        if removed_ids:
+            removed = [(int(i),) for i in removed_ids]
+            cursor.executemany('DELETE FROM tag_neighbors WHERE id = ?', removed)
+            cursor.executemany('DELETE FROM tag_neighbor_edges WHERE id = ?', removed)
+
+            # Rows that listed a removed tag lose a neighbor, recompute them from their vectors
+            stale_ids = set()
+            for start in range(0, len(removed), neighbor_graph_batch):
+                chunk = [i for i, in removed[start:start + neighbor_graph_batch]]
+                placeholder = ', '.join(['?'] * len(chunk))
+                cursor.execute(f'SELECT DISTINCT id FROM tag_neighbor_edges WHERE neighbor_id IN ({placeholder})', tuple(chunk))
+                stale_ids.update(i for i, in cursor.fetchall())
+            cursor.executemany('DELETE FROM tag_neighbor_edges WHERE neighbor_id = ?', removed)
+
+            stale_ids = sorted(stale_ids)
+            if stale_ids and k > 0:
+                D, I = self.get_id_map_index(index).search(self.get_vectors_from_ids(index, stale_ids), k)
+                self.write_neighbor_rows(cursor, stale_ids, D, I)
+
+        if added_ids and k > 0:
+            added_vectors = np.asarray(added_vectors, dtype=np.float32)
+            D, I = index.search(added_vectors, k)
+            self.write_neighbor_rows(cursor, added_ids, D, I)
+
+            added = set(int(i) for i in added_ids)
+            placeholder = ', '.join(['?'] * len(added))
+            cursor.execute(f'SELECT MAX(radius) FROM tag_neighbors WHERE id NOT IN ({placeholder})', tuple(added))
+            max_radius = cursor.fetchone()[0]
+
+            if max_radius is not None:
+                # Every existing tag whose row a new tag enters lies within the largest row radius of it
+                lims, RD, RI = index.range_search(added_vectors, max_radius)
+
+                entering = {}
+                for q, new_id in enumerate(added_ids):
+                    for distance, i in zip(RD[lims[q]:lims[q + 1]], RI[lims[q]:lims[q + 1]]):
+                        if int(i) not in added:
+                            entering.setdefault(int(i), []).append((float(distance), int(new_id)))
+
+                rows = []
+                entering_ids = list(entering)
+                for start in range(0, len(entering_ids), neighbor_graph_batch):
+                    chunk = entering_ids[start:start + neighbor_graph_batch]
+                    placeholder = ', '.join(['?'] * len(chunk))
+                    cursor.execute(
+                        f'SELECT id, neighbor_ids, distances, radius FROM tag_neighbors WHERE id IN ({placeholder})', tuple(chunk)
+                    )
+                    rows.extend(cursor.fetchall())
+
+                updated = []
+                for i, neighbor_ids, distances, radius in rows:
+                    candidates = [(d, new_id) for d, new_id in entering[i] if d < radius]
+                    if not candidates:
+                        continue
+
+                    merged = sorted(
+                        list(zip(np.frombuffer(distances, dtype=np.float32).tolist(), np.frombuffer(neighbor_ids, dtype=np.int64).tolist()))
+                        + candidates
+                    )
+                    updated.append(self.make_neighbor_row(
+                        i,
+                        np.array([d for d, _ in merged], dtype=np.float32),
+                        np.array([n for _, n in merged], dtype=np.int64),
+                    ))
+
+                self.store_neighbor_rows(cursor, updated)
+
+        conn.commit()
+        conn.close()
+
+    def get_neighbor_rows(self, title, tags):
+        tag_to_id = self.get_ids_from_tags(title, tags)
+        if not tag_to_id:
+            return {}
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+
+        placeholder = ', '.join(['?'] * len(tag_to_id))
+        cursor.execute(
+            f'SELECT id, neighbor_ids, distances FROM tag_neighbors WHERE id IN ({placeholder})', tuple(tag_to_id.values())
+        )
+        rows = {i: (neighbor_ids, distances) for i, neighbor_ids, distances in cursor.fetchall()}
+        conn.close()
+
+        # A real tag is its own nearest neighbor, put it first at distance 0 as a search would
+        return {
+            tag: (
+                np.concatenate(([i], np.frombuffer(rows[i][0], dtype=np.int64))),
+                np.concatenate(([0.0], np.frombuffer(rows[i][1], dtype=np.float32))),
+            )
+            for tag, i in tag_to_id.items() if i in rows
+        }
+
+    def get_tag_neighbors(self, title, tags):
+        if isinstance(tags, str):
+            tags = [tags]
+
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        if not tags or not os.path.exists(db_path):
+            return {}
+
+        rows = self.get_neighbor_rows(title, tags)
+        id_to_tag = self.get_tags_from_ids(title, set(int(i) for ids, _ in rows.values() for i in ids[1:]))
+
+        return {
+            tag: [(id_to_tag[int(i)], float(d)) for i, d in zip(ids[1:], distances[1:]) if int(i) in id_to_tag]
+            for tag, (ids, distances) in rows.items()
+        }
+
+    def get_id_map_index(self, index):
+        # A reduced index wraps the id map in the PCA projection and normalization
+        if isinstance(index, faiss.IndexPreTransform):
+            return faiss.downcast_index(index.index)
+        return index
+
+    def get_full_dimension_vectors(self, title):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+
+        self.checkpoint(title)
+        index = faiss.read_index(db_path)
+        id_map_index = self.get_id_map_index(index)
+
+        if id_map_index is index:
+            vectors = index.index.reconstruct_n(0, index.ntotal)
+            ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+            return ids, vectors
+
+        # The projection drops information, so a reduced index has to be re-embedded from its tags
+        tag_to_id = self.get_all_tag_ids(title)
+        tags = list(tag_to_id)
+        ids = np.array([tag_to_id[t] for t in tags], dtype=np.int64)
+        vectors = self.encode_tags(tags) if tags else np.zeros((0, embedding_dim), dtype=np.float32)
+        return ids, vectors
+
+    def train_projection(self, vectors, dim):
+        pca = faiss.PCAMatrix(embedding_dim, dim)
+        pca.train(vectors)
+        return pca
+
+    def create_reduced_index(self, pca, dim):
+        index = faiss.IndexPreTransform(faiss.IndexIDMap2(faiss.IndexFlatL2(dim)))
+        # Projected vectors are shorter than unit length, renormalized their squared L2 distance maps to a cosine again, that of the
+        # centered projections, which only approximates the full-dimension cosine
+        index.prepend_transform(faiss.NormalizationTransform(dim, 2.0))
+        index.prepend_transform(pca)
+        return index
+
+    def reduce_dimensions(self, title, dim=reduced_dim):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        if not os.path.exists(db_path):
+            return False
+
+        ids, vectors = self.get_full_dimension_vectors(title)
+
+        if dim is None or dim >= embedding_dim:
+            index = faiss.IndexIDMap2(faiss.IndexFlatL2(embedding_dim))
+        else:
+            if len(vectors) < reduction_min_vectors:
+                print(f"At least {reduction_min_vectors} tags are needed to train the projection.")
+                return False
+            pca = self.train_projection(vectors, dim)
+            # The projection is stored with the index, so queries and journaled adds are projected on the way in
+            index = self.create_reduced_index(pca, dim)
+
+        if len(ids) > 0:
+            index.add_with_ids(vectors, ids)
+        self.write_index_atomic(index, db_path)
+        self._index_cache.pop(title, None)
+
+        # Distances changed, so a built neighbor graph has to be recomputed in the new space
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM tag_neighbors')
+        has_graph = cursor.fetchone()[0] > 0
+        conn.close()
+        if has_graph:
+            self.build_neighbor_graph(title)
+
+        return True
+
+    def evaluate_reduction(self, title, dim=reduced_dim, k=10):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        if not os.path.exists(db_path):
+            return None
+
+        ids, vectors = self.get_full_dimension_vectors(title)
+        if len(vectors) < reduction_min_vectors:
+            print(f"At least {reduction_min_vectors} tags are needed to train the projection.")
+            return None
+
+        full_index = faiss.IndexIDMap(faiss.IndexFlatL2(embedding_dim))
+        full_index.add_with_ids(vectors, ids)
+
+        pca = self.train_projection(vectors, dim)
+        reduced_index = self.create_reduced_index(pca, dim)
+        reduced_index.add_with_ids(vectors, ids)
+
+        # Stored tags stand in for queries, the exact full-dimension neighbors are the ground truth
+        sample = np.random.default_rng(0).choice(len(vectors), min(evaluation_sample_size, len(vectors)), replace=False)
+        queries = vectors[sample]
+        k = min(k, len(vectors))
+
+        start = time.perf_counter()
+        _, full_ids = full_index.search(queries, k)
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, reduced_ids = reduced_index.search(queries, k)
+        reduced_time = time.perf_counter() - start
+
+        recall = np.mean([len(set(f) & set(r)) / k for f, r in zip(full_ids.tolist(), reduced_ids.tolist())])
+
+        return {
+            "dim": dim,
+            "recall": float(recall),
+            "full_search_ms": full_time * 1000 / len(queries),
+            "reduced_search_ms": reduced_time * 1000 / len(queries),
+            "full_bytes": len(vectors) * embedding_dim * 4,
+            "reduced_bytes": len(vectors) * dim * 4,
+        }
+
+    def get_all_tag_ids(self, title):
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT tag, id FROM tag_ids')
+        tag_to_id = dict(cursor.fetchall())
+
+        conn.close()
+        return tag_to_id
+
+    def reconcile(self, title, tags=None):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        if not os.path.exists(db_path):
+            return None
+
+        report = {"orphan_vectors_removed": 0, "tags_removed": [], "tags_added": []}
+
+        if tags is None:
+            sql_tags = set(get_all_tags(title) or [])
+            tag_to_id = self.get_all_tag_ids(title)
+            candidates = sql_tags
+
+            # Compare against the base index with the journal folded in
+            self.checkpoint(title)
             index = faiss.read_index(db_path)
-            index_to_tag = self.load_index_to_tag_map(title)
-            tag_to_index = self.reverse_dict(index_to_tag)
-            deleted_ids = self.load_deleted_ids(title)  # Track deleted IDs
+            index_ids = set(faiss.vector_to_array(self.get_id_map_index(index).id_map).tolist())
+            store_ids = set(tag_to_id.values())
+
+            # Vectors with no tag mapping can never be returned, drop them and free their ids
+            orphan_ids = list(index_ids - store_ids)
+            if orphan_ids:
+                conn = self.connect_tag_store(title)
+                cursor = conn.cursor()
+                self.append_journal(cursor, "remove", orphan_ids)
+                cursor.executemany('INSERT OR IGNORE INTO free_ids (id) VALUES (?)', [(i,) for i in orphan_ids])
+                conn.commit()
+                conn.close()
+
+                report["orphan_vectors_removed"] = len(orphan_ids)
+
+            # Mapped tags whose vector is missing get dropped from the store here and re-embedded below
+            unindexed = {t: i for t, i in tag_to_id.items() if i not in index_ids}
+            if unindexed:
+                conn = self.connect_tag_store(title)
+                conn.executemany('DELETE FROM tag_ids WHERE id = ?', [(i,) for i in unindexed.values()])
+                conn.executemany('INSERT OR IGNORE INTO free_ids (id) VALUES (?)', [(i,) for i in unindexed.values()])
+                conn.commit()
+                conn.close()
 
+                for t in unindexed:
+                    del tag_to_id[t]
+
+            if orphan_ids or unindexed:
+                self.update_neighbor_graph(title, removed_ids=orphan_ids + list(unindexed.values()))
+        else:
+            if isinstance(tags, str):
+                tags = [tags]
+            sql_tags = set((get_tag_instances(title, tags) or {}).keys())
+            tag_to_id = self.get_ids_from_tags(title, tags)
+            candidates = tags
+
+        stale_tags = [t for t in tag_to_id if t not in sql_tags]
+        if stale_tags:
+            self.delete_entry_from_database(title, stale_tags)
+            report["tags_removed"] = stale_tags
+
+        missing_tags = [t for t in candidates if t in sql_tags and t not in tag_to_id]
+        if missing_tags:
+            self.add_entry_to_database(title, missing_tags)
+            report["tags_added"] = missing_tags
+
+        return report
+
+    def add_entry_to_database(self, title, tag):
+        db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
+        if os.path.exists(db_path):
             if isinstance(tag, str):
                 tag = [tag]
 
+            # Tag already exists, no need to add it again
+            existing = self.get_ids_from_tags(title, tag)
+            new_tags = []
             for t in tag:
-                if t in tag_to_index:
-                    continue  # Tag already exists, no need to add it again
-
-                # Calculate the embedding directly using the loaded model
-                vector = model.encode([t])[0].astype('float32')
-
-                # Reuse a deleted ID if available, otherwise add a new vector
-                if deleted_ids:
-                    reuse_id = deleted_ids.pop(0)  # Reuse the first available deleted ID
-                    index.add_with_ids(np.array([vector]), np.array([reuse_id]))
-                    index_id = reuse_id
-                else:
-                    index_id = index.ntotal - 1  # Assign the next available ID
-                    index.add_with_ids(np.array([vector]), index_id)
-
-                index_to_tag[index_id] = t  # Update the tag map with the new ID
-
-            faiss.write_index(index, db_path)
-            self.save_index_to_tag_map(title, index_to_tag)
-            self.save_deleted_ids(title, deleted_ids)  # Save updated list of deleted IDs
+                if t not in existing and t not in new_tags:
+                    new_tags.append(t)
+
+            if not new_tags:
+                return True
+
+            # Calculate the embeddings for all new tags in one batch
+            vectors = self.encode_tags(new_tags)
+
+            conn = self.connect_tag_store(title)
+            cursor = conn.cursor()
+
+            new_ids = self.allocate_ids(cursor, len(new_tags))
+            cursor.executemany('''
+            INSERT INTO tag_ids (id, tag) VALUES (?, ?)
+            ''', list(zip(new_ids, new_tags)))
+
+            # The batch and its id changes commit together, the base index is left untouched
+            self.append_journal(cursor, "add", new_ids, vectors)
+
+            conn.commit()
+            conn.close()
+
+            self.update_neighbor_graph(title, added_ids=new_ids, added_vectors=vectors)
+            self.checkpoint_if_needed(title)
             return True
         return False
 
 
-    def get_nearest_neighbors(self, title, tag, k=20):
+    def get_nearest_neighbors(self, title, tag, k=20, tag_filter=None):
         db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
         neighbors = []
         if os.path.exists(db_path):
             model = self.get_model()
-            index = faiss.read_index(db_path)
+            index = self.load_index(title)
 
             if isinstance(tag, str):
                 tag = [tag]
@@ -159,57 +1092,283 @@ class TagDatabaseHandler:
             tag_vectors = np.array([model.encode([t])[0].astype('float32') for t in tag])
 
             num_vectors = index.ntotal
+            params = None
+            if tag_filter:
+                params, num_vectors = self.get_search_params(title, index, tag_filter)
             k = min(k, num_vectors)
             if k == 0:
                 return []
             
-            D, I = index.search(tag_vectors, k)
+            D, I = index.search(tag_vectors, k, params=params)
 
-            index_to_tag = self.load_index_to_tag_map(title)
-            neighbors = [[index_to_tag.get(str(i), "Unknown") for i in row] for row in I]
+            id_to_tag = self.get_tags_from_ids(title, set(i for row in I for i in row if i != -1))
+            neighbors = [[id_to_tag.get(int(i), "Unknown") for i in row] for row in I]
             
         return neighbors
 
-    def reverse_dict(self, original_dict):
-        return {v: k for k, v in original_dict.items()}
+    def get_filter_selector(self, title, tag_filter):
+        doc_path = os.path.join(DOC_DATABASE_DIR, title)
+        if not os.path.exists(doc_path):
+            return None, 0
+
+        # A filter matches a different id set once documents or tag ids change. The store file itself is also written by
+        # selection stats, so its journal sequence stands for the id map, which only changes together with the journal.
+        conn = self.connect_tag_store(title)
+        versions = (get_last_modified(title), self.get_store_version(conn.cursor()))
+        conn.close()
+        key = (title, tuple(sorted(
+            (name, tuple(value) if isinstance(value, (list, tuple)) else value) for name, value in tag_filter.items()
+        )))
+
+        cached = self._filter_cache.get(key)
+        if cached is not None and cached[0] == versions:
+            return cached[1], cached[2]
+
+        tags = get_tags_from_filter(title, tag_filter) or []
+        ids = np.array(sorted(self.get_ids_from_tags(title, tags).values()), dtype=np.int64)
+        selector = faiss.IDSelectorBatch(ids)
+
+        self._filter_cache.pop(key, None)
+        if len(self._filter_cache) >= filter_cache_size:
+            self._filter_cache.pop(next(iter(self._filter_cache)))
+        self._filter_cache[key] = (versions, selector, len(ids))
+
+        return selector, len(ids)
+
+    def get_search_params(self, title, index, tag_filter):
+        selector, num_ids = self.get_filter_selector(title, tag_filter)
+        if num_ids == 0:
+            return None, 0
+
+        # The serving layout is an IVF index, whose search parameters also carry nprobe
+        base = index.base if isinstance(index, JournalOverlayIndex) else index
+        if faiss.try_extract_index_ivf(base) is not None:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=serving_nprobe), num_ids
+        return faiss.SearchParameters(sel=selector), num_ids
+
+    def prefetch_tags(self, tags):
+        if isinstance(tags, str):
+            tags = [tags]
+
+        # Only the worker can embed in the background, in-process backends would just block here
+        model = self.get_model()
+        if isinstance(model, EmbeddingWorker) and tags and tuple(tags) not in self._pending_embeddings:
+            self._pending_embeddings[tuple(tags)] = model.submit(tags)
+
+    def encode_tags(self, tags, prefetched_tags=None):
+        # tags may be a subset of a prefetched batch, in which case their rows are picked out of it
+        prefetched_tags = list(prefetched_tags or tags)
+        pending = self._pending_embeddings.pop(tuple(prefetched_tags), None)
+        if pending is not None:
+            tag_vectors = pending.result().astype('float32')[[prefetched_tags.index(t) for t in tags]]
+        else:
+            model = self.get_model()
+            tag_vectors = model.encode(tags).astype('float32')
+        # Stored vectors are unit length, so squared L2 distance d maps to cosine similarity 1 - d / 2
+        faiss.normalize_L2(tag_vectors)
+        return tag_vectors
+
+    def get_graph_rows(self, title, tags, k, tag_filter=None):
+        if self.load_index(title) is None:
+            return None
+        # Filtered queries and k beyond the stored rows have to go through the index
+        if tag_filter or k > neighbor_graph_k:
+            return {}
+        return self.get_neighbor_rows(title, tags)
+
+    def search_tags(self, title, tags, k=20, max_distance=None, min_similarity=None, metric="l2", tag_filter=None):
+        results = self.search_tags_federated([title], tags, k, max_distance, min_similarity, metric, tag_filter)
+        return [(tag, score, instances) for _, tag, score, instances in results]
+
+    def search_tags_federated(self, titles, tags, k=20, max_distance=None, min_similarity=None, metric="l2", tag_filter=None):
+        if isinstance(tags, str):
+            tags = [tags]
+        if not tags or not titles:
+            return []
+
+        # Query tags that are real tags with a neighbor graph row are answered by lookup, only the rest are embedded
+        graph_rows = {title: self.get_graph_rows(title, tags, k, tag_filter) for title in titles}
+        missed = [t for t in tags if any(rows is not None and t not in rows for rows in graph_rows.values())]
+
+        if missed:
+            # Embed once, then search every database's index in parallel (FAISS releases the GIL while searching)
+            tag_vectors = self.encode_tags(missed, tags)
+        else:
+            self._pending_embeddings.pop(tuple(tags), None)
+            tag_vectors = None
+
+        def search_title(title):
+            rows = graph_rows[title]
+            if rows is None:
+                return []
+            title_missed = [i for i, t in enumerate(missed) if t not in rows]
+            title_vectors = tag_vectors[title_missed] if title_missed else None
+            return self.search_vectors(title, title_vectors, k, max_distance, min_similarity, metric, tag_filter, rows)
+
+        with ThreadPoolExecutor(max_workers=len(titles)) as executor:
+            results = list(executor.map(search_title, titles))
+
+        merged = [
+            (title, tag, score, instances)
+            for title, result in zip(titles, results)
+            for tag, score, instances in result
+        ]
+        merged.sort(key=lambda item: item[2], reverse=(metric == "cosine"))
+
+        return merged
+
+    def search_vectors(self, title, tag_vectors, k=20, max_distance=None, min_similarity=None, metric="l2", tag_filter=None, graph_rows=None):
+        if metric not in ["l2", "cosine"]:
+            raise ValueError("Metric must be either 'l2' or 'cosine'")
+
+        index = self.load_index(title)
+        if index is None:
+            return []
+
+        num_vectors = index.ntotal
+        params = None
+        if tag_filter:
+            params, num_vectors = self.get_search_params(title, index, tag_filter)
+
+        k = min(k, num_vectors)
+        if k == 0:
+            return []
+
+        # Neighbor lists from the graph and from searching the index are cut and deduplicated the same way
+        neighbor_lists = [(distances[:k], ids[:k]) for ids, distances in (graph_rows or {}).values()]
+        if tag_vectors is not None and len(tag_vectors) > 0:
+            D, I = index.search(tag_vectors, k, params=params)
+            neighbor_lists.extend(zip(D, I))
+
+        best_distances = {}
+        for row_distances, row_ids in neighbor_lists:
+            for distance, i in zip(row_distances, row_ids):
+                if i == -1:
+                    continue
+                if max_distance is not None and distance > max_distance:
+                    continue
+                if min_similarity is not None and 1 - distance / 2 < min_similarity:
+                    continue
+                i = int(i)
+                if i not in best_distances or distance < best_distances[i]:
+                    best_distances[i] = float(distance)
+
+        id_to_tag = self.get_tags_from_ids(title, best_distances.keys())
+        instances = get_tag_instances(title, list(id_to_tag.values())) or {}
+
+        results = []
+        for i, distance in sorted(best_distances.items(), key=lambda item: item[1]):
+            if i not in id_to_tag:
+                continue
+            tag = id_to_tag[i]
+            score = 1 - distance / 2 if metric == "cosine" else distance
+            results.append((tag, score, instances.get(tag, 0)))
+
+        return results
+
+    def record_tag_selection(self, title, candidates, selected):
+        # A serving replica doesn't write to the stores it reads from
+        if self.read_only or not candidates:
+            return
 
-    def save_deleted_ids(self, title, deleted_ids):
-        deleted_ids_path = os.path.join(DATABASE_DIR, f"{title}-deleted-ids.json")
-        with open(deleted_ids_path, 'w') as f:
-            json.dump(deleted_ids, f)
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
 
-    def load_deleted_ids(self, title):
-        deleted_ids_path = os.path.join(DATABASE_DIR, f"{title}-deleted-ids.json")
-        if os.path.exists(deleted_ids_path):
-            with open(deleted_ids_path, 'r') as f:
-                return json.load(f)
-        return []
+        cursor.executemany('''
+        INSERT INTO tag_selections (tag, candidate_count, selected_count) VALUES (?, 1, 0)
+        ON CONFLICT(tag) DO UPDATE SET candidate_count = candidate_count + 1
+        ''', [(t,) for t in set(candidates)])
+
+        cursor.executemany('''
+        UPDATE tag_selections SET selected_count = selected_count + 1 WHERE tag = ?
+        ''', [(t,) for t in set(selected) if t in candidates])
+
+        conn.commit()
+        conn.close()
+
+    def get_selection_rates(self, title, tags):
+        if not tags:
+            return {}
+
+        conn = self.connect_tag_store(title)
+        cursor = conn.cursor()
+
+        placeholder = ', '.join(['?'] * len(tags))
+        cursor.execute(f'SELECT tag, candidate_count, selected_count FROM tag_selections WHERE tag IN ({placeholder})', tuple(tags))
+        counts = {tag: (candidate_count, selected_count) for tag, candidate_count, selected_count in cursor.fetchall()}
+
+        conn.close()
+
+        # Laplace smoothed, so tags that were never offered start at 0.5
+        return {
+            t: (counts.get(t, (0, 0))[1] + 1) / (counts.get(t, (0, 0))[0] + 2)
+            for t in tags
+        }
+
+    def rerank_tags(self, results, weights=None, limit=None, metric="cosine"):
+        if metric not in ["l2", "cosine"]:
+            raise ValueError("Metric must be 'l2' or 'cosine'")
+        if weights is None:
+            weights = rerank_weights
+
+        tags_by_title = {}
+        for title, tag, similarity, instances in results:
+            tags_by_title.setdefault(title, []).append(tag)
+
+        document_counts = {}
+        selection_rates = {}
+        for title, tags in tags_by_title.items():
+            document_counts[title] = get_number_of_documents(title) or 0
+            selection_rates[title] = self.get_selection_rates(title, tags)
+
+        reranked = []
+        for title, tag, search_score, instances in results:
+            # Squared L2 distance between unit vectors, lower is closer
+            similarity = 1 - search_score / 2 if metric == "l2" else search_score
+            document_count = document_counts[title]
+            # IDF scaled to [0, 1]: a tag on a single sub-doc scores near 1, a tag on every sub-doc scores 0
+            if document_count > 0:
+                idf = np.log((document_count + 1) / (instances + 1)) / np.log(document_count + 1)
+            else:
+                idf = 0.0
+
+            score = (
+                weights["similarity"] * similarity
+                + weights["idf"] * idf
+                + weights["history"] * selection_rates[title][tag]
+            )
+            reranked.append((title, tag, float(score), instances))
+
+        reranked.sort(key=lambda item: item[2], reverse=True)
+
+        if limit is not None:
+            reranked = reranked[:limit]
+        return reranked
 
     def delete_entry_from_database(self, title, tags):
         db_path = os.path.join(DATABASE_DIR, f"{title}.bin")
-        index = faiss.read_index(db_path)
-        index_to_tag = self.load_index_to_tag_map(title)
-        tag_to_index = self.reverse_dict(index_to_tag)
-        deleted_ids = self.load_deleted_ids(title)  # Track deleted IDs
+        if not os.path.exists(db_path):
+            return
 
         if isinstance(tags, str):
             tags = [tags]
 
+        tag_to_id = self.get_ids_from_tags(title, tags)
+
         # Prepare a list of tag indices to remove
-        indices_to_remove = [int(tag_to_index[t]) for t in tags if t in tag_to_index]
+        indices_to_remove = list(tag_to_id.values())
 
         if indices_to_remove:
-            id_selector = faiss.IDSelectorBatch(np.array(indices_to_remove, dtype=np.int64))
-            index.remove_ids(id_selector)
+            conn = self.connect_tag_store(title)
+            cursor = conn.cursor()
 
-            # Remove tags from index-to-tag map and track the deleted IDs
-            for t in tags:
-                if t in tag_to_index:
-                    tag_index = tag_to_index[t]
-                    del index_to_tag[tag_index]  # Remove from tag map
-                    deleted_ids.append(tag_index)  # Track deleted ID for reuse
+            # Remove tags from the id store and track the deleted ids for reuse
+            cursor.executemany('DELETE FROM tag_ids WHERE id = ?', [(i,) for i in indices_to_remove])
+            cursor.executemany('INSERT OR IGNORE INTO free_ids (id) VALUES (?)', [(i,) for i in indices_to_remove])
+            self.append_journal(cursor, "remove", indices_to_remove)
 
-            faiss.write_index(index, db_path)
-            self.save_index_to_tag_map(title, index_to_tag)
-            self.save_deleted_ids(title, deleted_ids)  # Save updated list of deleted IDs
+            conn.commit()
+            conn.close()
 
+            self.update_neighbor_graph(title, removed_ids=indices_to_remove)
+            self.checkpoint_if_needed(title)
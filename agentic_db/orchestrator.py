@@ -1,18 +1,49 @@
+import json
+import hashlib
 from agentic_db.handlers.llm_handler import LLMHandler
 from agentic_db.handlers.tag_database_handler import TagDatabaseHandler
 from agentic_db.handlers.doc_database_handler import *
+from agentic_db.handlers.model_residency_handler import ModelResidencyHandler
+from agentic_db.handlers.conversation_handler import ConversationHandler
+from agentic_db.handlers.answer_cache_handler import AnswerCacheHandler
+from agentic_db.handlers.memo_handler import MemoHandler
 
 
 class Orchestrator:
-    def __init__(self):
-        self.llm_handler = LLMHandler()
-        self.tag_handler = TagDatabaseHandler()
+    def __init__(self, read_only=False, embedding_backend=None, embedding_worker=False, parallel_ingest=False):
+        # both models stay loaded while the RAM budget allows instead of being reloaded every step
+        self.residency = ModelResidencyHandler()
+        self.llm_handler = LLMHandler(residency=self.residency)
+        self.tag_handler = TagDatabaseHandler(
+            read_only=read_only,
+            residency=self.residency,
+            embedding_backend=embedding_backend,
+            embedding_worker=embedding_worker,
+        )
         self.mode = "single_query"
+        # neighbors less similar than this never reach the relevance grammar
+        self.neighbor_min_similarity = 0.35
+        # candidates handed to the relevance step after reranking
+        self.relevance_candidate_limit = 15
+        # parallel ingest generates sub-documents side by side and skips subjects this similar to a tag already produced
+        self.parallel_ingest = parallel_ingest
+        self.subject_coverage_similarity = 0.8
+        # single query answers per database, matched by normalized or similar prompt, dropped when documents change
+        self.answer_cache = AnswerCacheHandler(self.tag_handler.encode_tags)
+        # roadmaps and relevant tag selections are memoized, with greedy sampling so the same input gives the same output
+        self.memo = MemoHandler()
+        self.set_memoization(True)
         self.system_prompt = """You are a knowledgeable chatbot that answers questions and assists users. You have access to a hybrid database tool built with SQL and a Vector DB.
         Your database uses agentic LLM models that can create roadmaps to answer problems. When retrieving data from the database, if the answer is not present in the provided
         data, candidly state as much.  Defer with complete adherence to the information retrieved from the database over your own general knowledge. 
         Be clear, effective, and succinct in your responses while also fully explaining requested concepts."""
-        self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+        # chat history kept within a token budget, older turns are folded into a rolling summary
+        self.conversation = ConversationHandler(
+            self.llm_handler.get_token_count, self.llm_handler.summarize_conversation
+        )
+        # the same list object for the life of the orchestrator, the conversation handler edits it in place
+        self.conversation_history = self.conversation.messages
+        self.clear_conversation_history()
 
     def get_existing_databases(self):
         return get_existing_databases()
@@ -26,6 +57,8 @@ class Orchestrator:
 
     def delete_database(self, db_file):
         self.tag_handler.delete_database(db_file)
+        self.llm_handler.delete_token_cache(db_file)
+        self.answer_cache.delete_cache(db_file)
         return delete_database(db_file)
 
     def create_database(self, title):
@@ -33,6 +66,74 @@ class Orchestrator:
         self.tag_handler.create_database(db_file)
         return db_file
 
+    def build_serving_index(self, db_file):
+        return self.tag_handler.build_serving_index(db_file)
+
+    def reduce_dimensions(self, db_file, dim):
+        return self.tag_handler.reduce_dimensions(db_file, dim)
+
+    def evaluate_reduction(self, db_file, dim):
+        return self.tag_handler.evaluate_reduction(db_file, dim)
+
+    def build_neighbor_graph(self, db_file):
+        return self.tag_handler.build_neighbor_graph(db_file)
+
+    def get_model_stats(self):
+        return self.residency.get_stats()
+
+    def get_prompt_cache_stats(self):
+        return self.llm_handler.get_prompt_cache_stats()
+
+    def set_step_model(self, step, size):
+        return self.llm_handler.set_step_model(step, size)
+
+    def get_answer_cache_stats(self):
+        return self.answer_cache.get_stats()
+
+    def set_memoization(self, enabled):
+        self.memoize = enabled
+        self.llm_handler.deterministic = enabled
+
+    def get_memo_stats(self):
+        return self.memo.get_stats()
+
+    def set_speculative_decoding(self, mode):
+        return self.llm_handler.set_speculative_decoding(mode)
+
+    def get_generation_stats(self):
+        return self.llm_handler.get_generation_stats()
+
+    def generate_roadmap(self, prompt):
+        if not self.memoize:
+            return self.llm_handler.generate_roadmap(prompt)
+
+        # Roadmaps never look at a database, only the model producing them matters
+        version = self.llm_handler.get_model_key(self.llm_handler.get_step_size("generate_roadmap"))
+        key = self.memo.get_memo_key(prompt)
+
+        roadmap = self.memo.get("roadmaps", key, version)
+        if roadmap is None:
+            roadmap = self.llm_handler.generate_roadmap(prompt)
+            self.memo.set("roadmaps", key, version, roadmap)
+        return roadmap
+
+    def return_relevant_tags(self, explanation, candidate_tags, database_titles):
+        if not self.memoize:
+            return self.llm_handler.return_relevant_tags(explanation, candidate_tags, database_titles)
+
+        # A selection is kept until the model or any of the databases it was made against changes
+        version = json.dumps(
+            [self.llm_handler.get_model_key(self.llm_handler.get_step_size("return_relevant_tags"))]
+            + [get_last_modified(title) for title in database_titles]
+        )
+        key = self.memo.get_memo_key(explanation, sorted(set(candidate_tags)), sorted(database_titles))
+
+        relevant_tags = self.memo.get("relevant_tags", key, version)
+        if relevant_tags is None:
+            relevant_tags = self.llm_handler.return_relevant_tags(explanation, candidate_tags, database_titles)
+            self.memo.set("relevant_tags", key, version, relevant_tags)
+        return relevant_tags
+
     def get_database_custom_prompt(self, db_file):
         return get_custom_prompt(db_file)
 
@@ -49,14 +150,24 @@ class Orchestrator:
         return get_original_documents_from_textual_match(db_file, search_text)
 
     def remove_original_document(self, db_file, doc_uuid):
-        return remove_original_document(db_file, doc_uuid)
+        deleted_tags = remove_original_document(db_file, doc_uuid)
+
+        # tags that dropped to zero instances would otherwise stay searchable in the tag index forever
+        if deleted_tags:
+            self.tag_handler.reconcile(db_file, deleted_tags)
+
+        return deleted_tags
+
+    def reconcile_database(self, db_file):
+        return self.tag_handler.reconcile(db_file)
 
     def get_all_tags(self, db_file):
         return get_all_tags(db_file)
 
     def process_document(self, document, db_file, file_path=None):
-        self.tag_handler.release_model()
-        subdocs = self.llm_handler.break_up_and_summarize_text(document)
+        subdocs = self.llm_handler.break_up_and_summarize_text(
+            document, parallel=self.parallel_ingest, is_covered=self.subject_covered
+        )
 
         subdocs_tags = []
 
@@ -64,12 +175,20 @@ class Orchestrator:
             for tag in subdoc["tags"]:
                 subdocs_tags.append(tag)
 
-        self.llm_handler.release_model()
-
         self.tag_handler.add_entry_to_database(db_file, subdocs_tags)
 
         add_entry_to_database(db_file, document, subdocs, file_path=file_path)
 
+    def subject_covered(self, subject, subdocs):
+        tags = [tag for subdoc in subdocs for tag in subdoc["tags"]]
+        if not tags:
+            return False
+
+        # Subjects are compared in tag form, the form every tag vector was embedded in
+        subject_tag = "_".join(subject.lower().split())
+        vectors = self.tag_handler.encode_tags([subject_tag] + tags)
+        return float((vectors[1:] @ vectors[0]).max()) >= self.subject_coverage_similarity
+
     def change_mode(self, mode):
         if mode not in ["chat_mode", "single_query"]:
             raise ValueError("Mode must be either 'chat_mode' or 'single_query'")
@@ -80,33 +199,57 @@ class Orchestrator:
     def get_mode(self):
         return self.mode
 
-    def database_query(self, conversation_history, prompt, database_title):
-        roadmap = self.llm_handler.generate_roadmap(prompt)
+    # database_title may be a single database file or a list of them for a federated query
+    # tag_filter optionally scopes the query to some original documents, document types or dates (see doc_database_handler)
+    # on_token, if given, is called with every answer token as it is generated
+    def database_query(self, conversation_history, prompt, database_title, tag_filter=None, on_token=None):
+        roadmap = self.generate_roadmap(prompt)
+
+        database_titles = database_title if isinstance(database_title, (list, tuple)) else [database_title]
 
         context = []
 
-        for step in roadmap:
+        for step_index, step in enumerate(roadmap):
             print(step[1])
 
-            # get real tags from prospective
-            real_tags = self.tag_handler.get_nearest_neighbors(
-                database_title, step[0], 10
+            # get real tags from prospective, deduplicated and cut by similarity, and remember which databases own each tag
+            real_tags = self.tag_handler.search_tags_federated(
+                database_titles,
+                step[0],
+                10,
+                min_similarity=self.neighbor_min_similarity,
+                metric="cosine",
+                tag_filter=tag_filter,
+            )
+
+            if len(real_tags) == 0:
+                continue
+
+            # weigh in how specific each tag is and how often it was picked before, keep the best few
+            real_tags = self.tag_handler.rerank_tags(
+                real_tags, limit=self.relevance_candidate_limit, metric="cosine"
             )
 
-            self.tag_handler.release_model()
+            tag_owners = {}
+            for title, tag, score, instances in real_tags:
+                tag_owners.setdefault(tag, []).append(title)
 
             # get relevant tags from real
 
-            real_tags_pool = []
+            real_tags_pool = list(tag_owners)
 
-            for tag_list in real_tags:
-                for tag in tag_list:
-                    real_tags_pool.append(tag)
+            # embed the next step's tags while the LLM picks relevant tags for this one
+            if step_index + 1 < len(roadmap):
+                self.tag_handler.prefetch_tags(roadmap[step_index + 1][0])
 
-            relevant_tags = self.llm_handler.return_relevant_tags(
-                step[1], real_tags_pool
+            relevant_tags = self.return_relevant_tags(
+                step[1], real_tags_pool, database_titles
             )
 
+            for title in database_titles:
+                owned_tags = [tag for tag in real_tags_pool if title in tag_owners[tag]]
+                self.tag_handler.record_tag_selection(title, owned_tags, relevant_tags)
+
             if len(relevant_tags) == 0 or (
                 len(relevant_tags) == 1 and relevant_tags[0] == "nothing"
             ):
@@ -114,45 +257,92 @@ class Orchestrator:
 
             print("relevant tags: ", relevant_tags)
 
-            # get doc uuids from relevant tags
+            # get doc uuids from relevant tags, routed to the databases that own the primary tag
 
-            doc_uuids, doc_tags = get_document_uuid_tags_from_tags(
-                database_title, relevant_tags
+            title, doc_uuids, doc_tags = self.get_best_document_uuids(
+                tag_owners.get(relevant_tags[0], []), relevant_tags, tag_filter
             )
 
+            if not doc_uuids:
+                continue
+
             print("found ", len(doc_uuids), " documents with relevant tags")
             print("reading document with tags: ", doc_tags[0])
 
-            doc_text = get_document_text_from_uuid(database_title, doc_uuids[0])
+            doc_text = get_document_text_from_uuid(title, doc_uuids[0])
 
             context.append(doc_text)
 
         answer = self.llm_handler.generate_response_with_context(
-            conversation_history, context
+            conversation_history, context, on_token
         )
 
         return answer, context
 
-    def clear_conversation_history(self):
-        self.conversation_history = [{"role": "system", "content": self.system_prompt}]
+    def get_best_document_uuids(self, database_titles, tags, tag_filter=None):
+        best_title, best_uuids, best_tags = None, [], []
 
-    def load_conversation_history(self, conversation_history):
-        self.conversation_history = conversation_history
+        for title in database_titles:
+            doc_uuids, doc_tags = get_document_uuid_tags_from_tags(title, tags, tag_filter)
+            if not doc_uuids:
+                continue
+            # documents are sorted by matched tag count, compare the top one of each database
+            if not best_uuids or len(doc_tags[0]) > len(best_tags[0]):
+                best_title, best_uuids, best_tags = title, doc_uuids, doc_tags
 
-    def process_prompt(self, prompt, database_title):
-        self.tag_handler.release_model()
+        return best_title, best_uuids, best_tags
 
+    def clear_conversation_history(self):
+        self.conversation.reset([{"role": "system", "content": self.system_prompt}])
+
+    def load_conversation_history(self, conversation_history):
+        self.conversation.reset(conversation_history)
+
+    def set_conversation_token_budget(self, token_budget):
+        self.conversation.token_budget = token_budget
+
+    def get_answer_cache_key(self, database_title, tag_filter):
+        # Federated queries span several versions and aren't cached
+        if isinstance(database_title, (list, tuple)):
+            if len(database_title) != 1:
+                return None
+            database_title = database_title[0]
+        if database_title is None or get_last_modified(database_title) is None:
+            return None
+
+        # The same prompt gets a different answer under another system prompt or tag filter
+        scope = hashlib.sha1(
+            json.dumps([self.system_prompt, sorted((tag_filter or {}).items())]).encode("utf-8")
+        ).hexdigest()
+        return database_title, scope
+
+    def process_prompt(self, prompt, database_title, tag_filter=None, on_token=None):
         answer, context = None, None
 
         if self.mode == "single_query":
+            cache_key = self.get_answer_cache_key(database_title, tag_filter)
+            if cache_key is not None:
+                version = get_last_modified(cache_key[0])
+                cached = self.answer_cache.get_answer(cache_key[0], cache_key[1], prompt, version)
+                if cached is not None:
+                    print("answered from the answer cache")
+                    # A cached answer arrives at once, as a single token
+                    if on_token is not None:
+                        on_token(cached[0])
+                    return cached
+
             query_history = self.conversation_history + [
                 {"role": "user", "content": prompt}
             ]
 
-            answer, context = self.database_query(query_history, prompt, database_title)
+            answer, context = self.database_query(query_history, prompt, database_title, tag_filter, on_token)
+
+            if cache_key is not None and answer:
+                self.answer_cache.store_answer(cache_key[0], cache_key[1], prompt, version, answer, context)
 
         elif self.mode == "chat_mode":
             self.conversation_history.append({"role": "user", "content": prompt})
+            self.conversation.compact()
             context_messages = []
             if len(self.conversation_history) >= 4:
                 context_messages = self.conversation_history[-4:]
@@ -169,10 +359,10 @@ class Orchestrator:
                 self.conversation_history
             ):
                 answer, context = self.database_query(
-                    self.conversation_history, enriched_prompt, database_title
+                    self.conversation_history, enriched_prompt, database_title, tag_filter, on_token
                 )
             else:
-                answer = self.llm_handler.generate_response(self.conversation_history)
+                answer = self.llm_handler.generate_response(self.conversation_history, on_token)
 
             self.conversation_history.append({"role": "assistant", "content": answer})
 
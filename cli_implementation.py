@@ -1,8 +1,17 @@
 import shlex
 import os
+import sys
 from agentic_db import async_agentic_database
 
-async_agentic_database = async_agentic_database.AsyncAgenticDatabase()
+# --read-only opens tag indexes memory-mapped, for query-only processes sharing a host
+# --parallel-ingest generates the sub-documents of a document side by side on several model instances
+async_agentic_database = async_agentic_database.AsyncAgenticDatabase(
+    read_only="--read-only" in sys.argv, parallel_ingest="--parallel-ingest" in sys.argv
+)
+
+# --speculative drafts answer tokens from the retrieved context (prompt lookup decoding)
+if "--speculative" in sys.argv:
+    async_agentic_database.set_speculative_decoding("prompt_lookup")
 
 async_agentic_database.set_new_system_prompt('''You are a knowledgeable chatbot that answers questions and assists users. You have access to a hybrid database tool built with SQL and a Vector DB.
         Your database uses agentic LLM models that can create roadmaps to answer problems. When retrieving data from the database, if the answer is not present in the provided
@@ -22,10 +31,17 @@ Available commands:
 - set_db [database_number] (Set the default database)
 - mk_db [database_name] (Create a new database)
 - rm_db [database_number] (Delete a database)
+- reconcile [database_number] (Sync a database's tag index with its documents, removing stale tags)
+- serve_db [database_number] (Build the memory-mapped serving layout of a database's tag index)
+- graph_db [database_number] (Precompute the tag neighbor graph of a database for faster queries)
+- reduce_db [database_number] [dims] (Project a database's tag index to fewer dimensions with PCA, "full" restores it)
+- eval_reduce_db [database_number] [dims] (Measure recall, speed and memory of a PCA projection against the full index)
 - add [database_number] [document_path] (Add a document to the database)
 - ask [query] [database_number] (Send a single query to the database)
+- ask_all [query] (Send a single query searching across all databases)
 - q_size (Get the size of the document and prompt queues)
 - status (Get the current status of the system)
+- models (Show model load counts, load time, residency and prompt cache hits)
 - thread [database_number] (Start a chat thread in the database)
 - exit
     """)
@@ -157,6 +173,99 @@ def delete_database(db_number=None):
     else:
         print(f"Database '{db_number}' not found.")
 
+def reconcile_database(db_number=None):
+    if not db_number:
+        list_databases()
+        db_number = int(input("Enter the database # to reconcile: ")) - 1
+    else:
+        db_number=int(db_number) - 1
+
+    databases = async_agentic_database.get_existing_databases()
+
+    if db_number in range(len(databases)):
+        report = async_agentic_database.reconcile_database(databases[db_number]["file"])
+        if report is None:
+            print(f"No tag index found for database '{databases[db_number]['title']}'.")
+            return
+        print(f"Orphan vectors removed: {report['orphan_vectors_removed']}")
+        print(f"Stale tags removed: {len(report['tags_removed'])} {report['tags_removed']}")
+        print(f"Missing tags added: {len(report['tags_added'])} {report['tags_added']}")
+    else:
+        print(f"Database '{db_number}' not found.")
+
+def build_serving_index(db_number=None):
+    if not db_number:
+        list_databases()
+        db_number = int(input("Enter the database # to build the serving index for: ")) - 1
+    else:
+        db_number=int(db_number) - 1
+
+    databases = async_agentic_database.get_existing_databases()
+
+    if db_number in range(len(databases)):
+        if async_agentic_database.build_serving_index(databases[db_number]["file"]):
+            print(f"Serving index built for database '{databases[db_number]['title']}'.")
+    else:
+        print(f"Database '{db_number}' not found.")
+
+def build_neighbor_graph(db_number=None):
+    if not db_number:
+        list_databases()
+        db_number = int(input("Enter the database # to build the neighbor graph for: ")) - 1
+    else:
+        db_number=int(db_number) - 1
+
+    databases = async_agentic_database.get_existing_databases()
+
+    if db_number in range(len(databases)):
+        if async_agentic_database.build_neighbor_graph(databases[db_number]["file"]):
+            print(f"Neighbor graph built for database '{databases[db_number]['title']}'.")
+        else:
+            print(f"No tag index found for database '{databases[db_number]['title']}'.")
+    else:
+        print(f"Database '{db_number}' not found.")
+
+def reduce_dimensions(db_number=None, dims=None):
+    if not db_number:
+        list_databases()
+        db_number = int(input("Enter the database # to reduce: ")) - 1
+    else:
+        db_number=int(db_number) - 1
+
+    if not dims:
+        dims = input("Enter the number of dimensions to keep (or 'full'): ")
+
+    databases = async_agentic_database.get_existing_databases()
+
+    if db_number in range(len(databases)):
+        dim = None if dims == "full" else int(dims)
+        if async_agentic_database.reduce_dimensions(databases[db_number]["file"], dim):
+            print(f"Tag index of database '{databases[db_number]['title']}' now uses {dims} dimensions.")
+    else:
+        print(f"Database '{db_number}' not found.")
+
+def evaluate_reduction(db_number=None, dims=None):
+    if not db_number:
+        list_databases()
+        db_number = int(input("Enter the database # to evaluate: ")) - 1
+    else:
+        db_number=int(db_number) - 1
+
+    if not dims:
+        dims = input("Enter the number of dimensions to evaluate: ")
+
+    databases = async_agentic_database.get_existing_databases()
+
+    if db_number in range(len(databases)):
+        report = async_agentic_database.evaluate_reduction(databases[db_number]["file"], int(dims))
+        if report is None:
+            return
+        print(f"Recall@10 at {report['dim']} dims: {report['recall']:.3f}")
+        print(f"Search time per query: {report['full_search_ms']:.3f}ms full, {report['reduced_search_ms']:.3f}ms reduced")
+        print(f"Vector memory: {report['full_bytes'] / 1024 / 1024:.1f}MB full, {report['reduced_bytes'] / 1024 / 1024:.1f}MB reduced")
+    else:
+        print(f"Database '{db_number}' not found.")
+
 def add_document(db_number=None, doc_name=None):
     databases = async_agentic_database.get_existing_databases()
     db_file = None
@@ -215,6 +324,50 @@ def queue_size():
 def status():
     print(async_agentic_database.status())
 
+def model_stats():
+    stats = async_agentic_database.get_model_stats()
+
+    for name, model_stats in stats.items():
+        resident = "resident" if model_stats["resident"] else "not loaded"
+        print(f"{name}: {resident}, loaded {model_stats['loads']} times, {model_stats['load_time']:.2f}s spent loading, ~{model_stats['size_estimate'] // (1024 * 1024)}MB")
+
+    for size, cache_stats in async_agentic_database.get_prompt_cache_stats().items():
+        print(f"{size} model prompt cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['tokens_reused']} prompt tokens reused, "
+              f"{cache_stats['states']} states (~{cache_stats['size'] // (1024 * 1024)}MB), "
+              f"{cache_stats['snapshots_loaded']} snapshots loaded, {cache_stats['snapshots_saved']} saved")
+
+    answer_stats = async_agentic_database.get_answer_cache_stats()
+    print(f"answer cache: {answer_stats['exact_hits']} exact hits, {answer_stats['similar_hits']} similar prompt hits, {answer_stats['misses']} misses")
+
+    for kind, memo_stats in async_agentic_database.get_memo_stats().items():
+        print(f"memoized {kind}: {memo_stats['hits']} hits, {memo_stats['misses']} misses")
+
+    for mode, generation_stats in async_agentic_database.get_generation_stats().items():
+        tokens_per_second = generation_stats["tokens"] / generation_stats["seconds"] if generation_stats["seconds"] else 0.0
+        print(f"answers with speculative decoding {mode}: {generation_stats['answers']} answers, {tokens_per_second:.2f} tokens/sec")
+
+def get_streaming_callbacks(prefix, on_response=None):
+    # Answer tokens are printed as they arrive, the callback only ends the line (or prints the answer if nothing was streamed)
+    streamed = []
+
+    def on_token(token):
+        if not streamed:
+            sys.stdout.write(prefix)
+        streamed.append(token)
+        sys.stdout.write(token)
+        sys.stdout.flush()
+
+    def callback(response):
+        if streamed:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+        else:
+            print(prefix + (response.get("response") or "No response available"))
+        if on_response:
+            on_response(response)
+
+    return on_token, callback
+
 def send_query(query=None, db_number=None):
     databases = async_agentic_database.get_existing_databases()
 
@@ -236,24 +389,32 @@ def send_query(query=None, db_number=None):
     if not query:
         query = input("Enter your query: ")
 
-    def callback(response):
-        prompt_text = response.get("prompt", "N/A")
-        answer = response.get("response", "No response available")
-        # context = response.get("context", "No context available")
-
-        print(f"Prompt: {prompt_text}")
-        print(f"Response: {answer}")
-        # print(f"Context: {context}\n")
+    on_token, callback = get_streaming_callbacks(f"Prompt: {query}\nResponse: ")
 
     if db_number is not None:
         packaged_query = [query, db_file]
-        async_agentic_database.add_prompt(packaged_query, callback)
+        async_agentic_database.add_prompt(packaged_query, callback, on_token)
     else:
         try:
-            async_agentic_database.add_prompt(query, callback)
+            async_agentic_database.add_prompt(query, callback, on_token)
         except Exception as e:
             print(f"Error sending query: {e}")
 
+def send_federated_query(query=None):
+    databases = async_agentic_database.get_existing_databases()
+
+    if not databases:
+        print("No databases to query.")
+        return
+
+    if not query:
+        query = input("Enter your query: ")
+
+    on_token, callback = get_streaming_callbacks(f"Prompt: {query}\nResponse: ")
+
+    packaged_query = [query, [database["file"] for database in databases]]
+    async_agentic_database.add_prompt(packaged_query, callback, on_token)
+
 
 def start_thread(db_number=None):
     databases = async_agentic_database.get_existing_databases()
@@ -290,16 +451,13 @@ def start_thread(db_number=None):
             break
 
         # Pass the user input as a message to the conversation in the agentic database system
-        def chat_callback(response):
-            prompt_text = response.get("prompt", "N/A")
-            reply = response.get("response", "No response available")
-            print(f"Agent: {reply}")
+        on_token, chat_callback = get_streaming_callbacks("Agent: ")
 
         if db_number is not None:
             chat_input = [user_input, db_file]  # Package message with the db_file
-            async_agentic_database.add_prompt(chat_input, chat_callback)
+            async_agentic_database.add_prompt(chat_input, chat_callback, on_token)
         else:
-            async_agentic_database.add_prompt(user_input, chat_callback)
+            async_agentic_database.add_prompt(user_input, chat_callback, on_token)
 
     
 
@@ -331,6 +489,16 @@ def handle_command(command_input):
         create_database(args[1] if len(args) > 1 else None)
     elif command == "rm_db":
         delete_database(args[1] if len(args) > 1 else None)
+    elif command == "reconcile":
+        reconcile_database(args[1] if len(args) > 1 else None)
+    elif command == "serve_db":
+        build_serving_index(args[1] if len(args) > 1 else None)
+    elif command == "graph_db":
+        build_neighbor_graph(args[1] if len(args) > 1 else None)
+    elif command == "reduce_db":
+        reduce_dimensions(args[1] if len(args) > 1 else None, args[2] if len(args) > 2 else None)
+    elif command == "eval_reduce_db":
+        evaluate_reduction(args[1] if len(args) > 1 else None, args[2] if len(args) > 2 else None)
     elif command == "add":
         if len(args) == 3:
             add_document(args[1], args[2])
@@ -342,8 +510,12 @@ def handle_command(command_input):
         queue_size()
     elif command == "status":
         status()
+    elif command == "models":
+        model_stats()
     elif command == "ask":
         send_query(" ".join(args[1:]) if len(args) > 1 else None)
+    elif command == "ask_all":
+        send_federated_query(" ".join(args[1:]) if len(args) > 1 else None)
     elif command == "thread":
         start_thread(" ".join(args[1:]) if len(args) > 1 else None)
     elif command == "exit":
@@ -0,0 +1,23 @@
+from embedding_handler import *
+import time
+
+# compare each CPU backend against the reference sentence_transformers model
+for backend in ["torch_int8", "onnx"]:
+    parity = check_backend_parity(backend)
+    print(backend, parity)
+
+    # vectors should be interchangeable with indexes built by the reference backend
+    assert parity["min_cosine"] > 0.98, f"{backend} drifted from the reference backend"
+
+# load and per-tag inference time for each backend
+for backend in ["sentence_transformers", "torch_int8", "onnx"]:
+    start = time.time()
+    model = create_embedding_backend(backend)
+    load_time = time.time() - start
+
+    start = time.time()
+    for text in parity_texts:
+        model.encode([text])
+    encode_time = (time.time() - start) / len(parity_texts)
+
+    print(f"{backend}: loaded in {load_time:.2f}s, {encode_time * 1000:.2f}ms per tag")
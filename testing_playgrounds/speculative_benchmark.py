@@ -0,0 +1,34 @@
+import os
+import sys
+
+'''
+Compares answer generation speed with and without speculative decoding. Answers the same questions about an example document,
+once per speculative decoding mode, and prints tokens/sec per mode from LLMHandler's generation stats. Answers that quote the
+retrieved context are where prompt lookup drafting pays off. Run from the repository root:
+python testing_playgrounds/speculative_benchmark.py
+'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agentic_db.handlers.llm_handler import LLMHandler
+
+modes = [None, "prompt_lookup", "draft_model"]
+questions = [
+    "Quote what the document says about how AWS Lambda scales.",
+    "What storage and compute services does AWS offer? Answer with the document's wording.",
+]
+
+with open(os.path.join("example_docs", "aws.txt"), "r") as f:
+    context = [f.read()]
+
+llm_handler = LLMHandler()
+llm_handler.deterministic = True
+
+for mode in modes:
+    llm_handler.set_speculative_decoding(mode)
+    for question in questions:
+        conversation_history = [{"role": "user", "content": question}]
+        llm_handler.generate_response_with_context(conversation_history, context)
+
+for mode, stats in llm_handler.get_generation_stats().items():
+    print(f"{mode}: {stats['tokens']} tokens in {stats['seconds']:.2f}s, {stats['tokens'] / stats['seconds']:.2f} tokens/sec")
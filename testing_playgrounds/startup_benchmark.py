@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+'''
+Guards CLI start-up time. Imports agentic_db in a fresh interpreter, constructs AsyncAgenticDatabase and lists databases, as the
+CLI does before ls / ls_db / prompt / q_size, then checks the time taken and that none of the heavy dependencies were actually
+loaded. Exits non-zero on failure. Run from anywhere: python testing_playgrounds/startup_benchmark.py
+'''
+
+max_startup_seconds = 1.0
+heavy_modules = ["torch", "sentence_transformers", "llama_cpp", "faiss", "numpy", "huggingface_hub"]
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+startup_code = f'''
+import sys
+import time
+
+start = time.perf_counter()
+from agentic_db.async_agentic_database import AsyncAgenticDatabase
+async_agentic_database = AsyncAgenticDatabase()
+async_agentic_database.get_existing_databases()
+elapsed = time.perf_counter() - start
+
+# lazily imported modules sit in sys.modules unexecuted until first attribute access
+loaded = [
+    name for name in {heavy_modules!r}
+    if name in sys.modules and type(sys.modules[name]).__name__ not in ("_LazyModule", "MissingModule")
+]
+print("elapsed=" + str(elapsed))
+print("loaded=" + ",".join(loaded))
+'''
+
+result = subprocess.run(
+    [sys.executable, "-c", startup_code], cwd=repo_root, capture_output=True, text=True
+)
+
+if result.returncode != 0:
+    print(result.stderr)
+    sys.exit(1)
+
+# the constructor may print, so only read the tagged lines
+report = dict(line.split("=", 1) for line in result.stdout.splitlines() if line.startswith(("elapsed=", "loaded=")))
+elapsed = float(report["elapsed"])
+loaded = [name for name in report["loaded"].split(",") if name]
+
+print(f"startup: {elapsed:.3f}s (limit {max_startup_seconds}s)")
+print(f"heavy modules loaded: {loaded if loaded else 'none'}")
+
+if elapsed > max_startup_seconds or loaded:
+    print("startup benchmark failed")
+    sys.exit(1)
+print("startup benchmark passed")